@@ -1,6 +1,13 @@
-import urllib.request, re, sys, os, json
+import urllib.request, urllib.parse, http.client, re, sys, os, json, time, threading, argparse, random, gzip, zlib, hashlib, subprocess
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 from urllib.error import URLError, HTTPError
-from typing import AnyStr, Optional, List, Tuple, Any
+from typing import AnyStr, Optional, List, Tuple, Any, Set, Union, Iterator, Callable, Dict
+from array import array
+
+# tsv_writer.py lives at the root of the repository, one level up, and is shared with the other script.
+# Keep the directory layout when copying this script elsewhere, or put a copy of tsv_writer.py next to it.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from tsv_writer import TsvWriter, repair_truncated_line
 
 
 
@@ -46,6 +53,62 @@ translation_priority = [[("spa", True ),
                         [("eng", True ),
                          ("eng", False)]]
 
+# How many sentences should be fetched at the same time?
+# Rows are still written to the file in page order, so the scrape stays resumable.
+max_workers = 4
+
+# How many audio files should be downloaded at the same time?
+# Audio downloads run in their own pool, so sentence pages keep being processed while mp3s transfer.
+audio_workers = 4
+
+# How many requests per second may be sent to tatoeba, across all workers?
+# Please be polite, tatoeba is run by volunteers.
+requests_per_second = 2.0
+
+# Rows are written to import.tsv in batches of this many rows, or after this many seconds, whichever comes first.
+# tsv_fsync is "flush" to fsync every batch, "close" to fsync only at the end, or "never".
+tsv_flush_rows = 50
+tsv_flush_seconds = 10.0
+tsv_fsync = "flush"
+
+# How many times should a request be retried after a connection error or a 429/5xx response?
+# Retries wait retry_backoff seconds, doubling every attempt, plus some random jitter.
+max_retries = 4
+retry_backoff = 1.0
+
+# Sentence pages are only read as far as the sentence JSON. If no more than this many bytes of the page are left,
+# they are read anyway so the connection can be reused. Leaving a larger remainder unread closes the connection,
+# which costs a new TCP and TLS handshake on the next request.
+drain_max_bytes = 64 * 1024
+
+# Downloaded pages are cached on disk, so that rerunning with a different translation_priority replays from disk.
+# Cached pages older than their time-to-live (in seconds) are revalidated with the server using their ETag.
+# Listing pages gain new sentences as audio is recorded, so they expire sooner than sentence pages.
+cache_dir = os.path.join("generated_files", "cache")
+cache_max_bytes = 2 * 1024 ** 3
+sentence_cache_ttl = 30 * 24 * 3600
+listing_cache_ttl = 24 * 3600
+
+# With --sync, only the newest listing pages are walked, until this many sentences in a row are already in the deck.
+# Sentences that no longer exist, or lack a translation in translation_priority, are remembered in skipped.txt
+# in the deck's folder and count as already in the deck. Sentences lacking a translation are only remembered for
+# the translation_priority they were skipped under, so changing it looks at them again.
+sync_stop_after = 30
+
+# Where should sentences be looked up? "api" asks a JSON endpoint, which is much smaller than the rendered page,
+# and falls back to the page for anything it cannot answer. "html" always reads the rendered page.
+# api_sentence_url is formatted with {id}. If api_batch_url is set, it is formatted with {ids}, a comma separated
+# list of up to api_batch_size IDs, and must answer with a list of sentences (optionally inside a "data" key).
+sentence_backend_name = "api"
+api_sentence_url = "https://tatoeba.org/eng/api_v0/sentence/{id}"
+api_batch_url = None
+api_batch_size = 50
+
+# With --postprocess, every mp3 is loudness-normalised to this integrated loudness (LUFS) with ffmpeg,
+# using this many processes. The codec and bitrate can be chosen on the command line, e.g. Opus for smaller files.
+postprocess_loudness = -16.0
+postprocess_workers = os.cpu_count() or 2
+
 
 
 
@@ -117,78 +180,226 @@ translation_priority = [[("spa", True ),
 
 
 
-def main():
+def main(decks: List["Deck"], sync: bool = False) -> None:
     """
     The main function that orchestrates the entire sentence scraping and processing workflow.
-    """
+    All decks are crawled at the same time, sharing the worker pools, the connection pool and the page cache.
 
-    # Set up the file system to ensure all necessary directories and files are in place
-    setup_filesystem(workspace, tsv_path)
+    :param decks: The decks to build, one per target language.
+    :param sync: Only top up the decks with the newest recordings instead of crawling every page.
+    """
 
     # Generate the translation priority list
     print(f"Using translation priority {translation_priority}")
 
-    # Initialize the page count to a high number which will be updated with the actual count
-    pages_count = 999999
+    # Every deck's sentences and audio go through the same two pools, so the limits apply to the whole process.
+    # Each deck also gets a lightweight thread of its own which walks its listing pages and writes its rows.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+         ThreadPoolExecutor(max_workers=audio_workers) as audio_executor, \
+         ThreadPoolExecutor(max_workers=len(decks)) as deck_executor:
+        crawl = sync_deck if sync else crawl_deck
+        crawls = [deck_executor.submit(crawl, deck, executor, audio_executor) for deck in decks]
+        for deck, crawl in zip(decks, crawls):
+            try:
+                crawl.result()
+            except Exception as e:
+                print(f"{deck.target_lang}: The crawl stopped because of an error: {e}")
+
+
+def crawl_deck(deck: "Deck", executor: ThreadPoolExecutor, audio_executor: ThreadPoolExecutor) -> None:
+    """
+    Crawls every listing page of one deck's language, resuming from its manifest.
 
-    # Read the TSV file to find which sentences have already been processed
-    with open(tsv_path, 'r') as file:
-        already_in_file = file.read()
+    :param deck: The deck to build.
+    :param executor: The pool which processes sentence pages.
+    :param audio_executor: The pool which downloads audio.
+    """
 
-    # Begin scraping from the first page
-    page_number = 1
-    while page_number < pages_count:
-        # Scrape a single page and process its sentences
-        scrape_one_page(page_number, already_in_file, pages_count, workspace)
-        
-        # Update the page number for the next iteration
-        page_number += 1
+    # Set up the file system to ensure all necessary directories and files are in place
+    setup_filesystem(deck.workspace, deck.tsv_path)
+
+    # Index the sentence IDs in the TSV file, and those skipped for good, to find which sentences have already been processed.
+    # append_to_file and record_skipped keep this set up to date as the crawl goes on.
+    already_in_file = load_sentence_ids(deck.tsv_path) | load_skipped_ids(deck.skipped_path)
+
+    # Load the crawl manifest, which remembers the page count and which pages are fully processed.
+    # The page count starts at a high number until the first listing page tells us the real one.
+    manifest = load_manifest(deck.manifest_path)
+    pages_count = manifest["pages_count"]
+
+    # Begin scraping from the first page that is not yet fully processed
+    page_number = first_incomplete_page(manifest)
+    if page_number > 1:
+        print(f"{deck.target_lang}: Resuming from page {page_number}, pages before it are already complete.")
+    with TsvWriter(deck.tsv_path, tsv_flush_rows, tsv_flush_seconds, tsv_fsync) as tsv_file:
+        while page_number < pages_count:
+            # A page after the first incomplete one may already have been finished by an earlier run
+            if manifest["pages"].get(str(page_number)) == "done":
+                page_number += 1
+                continue
+
+            # Scrape a single page and process its sentences
+            pages_count, page_complete = scrape_one_page(deck, page_number, already_in_file, pages_count, tsv_file, executor, audio_executor)
 
-        # Optionally, you can save the last processed page number to a file or database
-        # to resume later from where you left off
+            # The page's rows must be on disk before the page is checkpointed as done
+            tsv_file.flush()
 
+            # Checkpoint the page so that a restart can skip it
+            manifest["pages_count"] = pages_count
+            manifest["pages"][str(page_number)] = "done" if page_complete else "partial"
+            manifest["last_completed_page"] = first_incomplete_page(manifest) - 1
+            save_manifest(manifest, deck.manifest_path)
 
-def scrape_one_page(page_number, already_in_file, pages_count, workspace):
+            # Update the page number for the next iteration
+            page_number += 1
+
+    print(f"{deck.target_lang}: Reached the last page ({pages_count - 1}).")
+
+
+def scrape_one_page(deck, page_number, already_in_file, pages_count, tsv_file, executor, audio_executor) -> Tuple[int, bool]:
     """
     Scrapes a single page of sentences from Tatoeba for a specified language.
 
+    :param deck: The deck being built, which holds the language and where its files are stored.
     :param page_number: The current page number to scrape.
-    :param already_in_file: A set containing sentence numbers already processed.
+    :param already_in_file: A set containing sentence numbers (as strings) already processed.
     :param pages_count: The total number of pages available for scraping.
-    :param workspace: The directory where audio files are stored.
+    :param tsv_file: The TsvWriter for the import file.
+    :param executor: The pool which processes sentence pages.
+    :param audio_executor: The pool which downloads audio.
+    :return: A tuple of the updated pages count and whether every sentence on the page was handled without errors.
     """
     # Fetch the HTML content of the page
-    html = get_html(f'https://tatoeba.org/en/audio/index/{target_lang}?page={page_number}')
+    html = get_html(f'https://tatoeba.org/en/audio/index/{deck.target_lang}?page={page_number}', listing_cache_ttl)
 
     # Update the total number of pages if not already known
-    update_pages_count(html)
+    pages_count = update_pages_count(html, pages_count)
 
-    # Initialize a dictionary to hold sentence links
+    # Split the sentences on the page into new ones and ones we already have
     links_to_process = {}
+    skipped_sentences = set()
+    for sentence_number in sentence_ids_on_page(html):
+        if str(sentence_number) not in already_in_file:
+            links_to_process[sentence_number] = sentence_number
+        else:
+            skipped_sentences.add(sentence_number)
+
+    # Log the number of skipped files (sentences)
+    print(f"{deck.target_lang} PAGE {page_number}/{pages_count}: Skipping {len(skipped_sentences)} sentences already present in the file or skipped for good.")
+
+    failed_count = process_sentences(deck, [str(sentence_id) for sentence_id in links_to_process], already_in_file, tsv_file, executor, audio_executor)
+    if failed_count:
+        print(f"{deck.target_lang} PAGE {page_number}/{pages_count}: {failed_count} sentences failed, this page will be retried on the next run.")
+    return pages_count, failed_count == 0
+
+
+def sentence_ids_on_page(html: str) -> List[int]:
+    """
+    Extracts the sentence IDs listed on an audio listing page, in page order and without repeats.
+
+    :param html: The HTML content of the listing page.
+    :return: The sentence IDs.
+    """
+    sentence_ids = {}
 
     # Split the HTML content by the data attribute for sentence ID
     split_html = html.split("data-sentence-id=\"")
-    skipped_files_count = 0
 
     # Process each HTML segment to extract sentence numbers
     for split_string in split_html[1:]:
         # Extract the sentence number
         sentence_number_match = re.search(r'\d+', split_string)
         if sentence_number_match:
-            sentence_number = int(sentence_number_match.group(0))
+            sentence_ids[int(sentence_number_match.group(0))] = None
 
-            # Check if we already have this sentence, if not add to links_to_process
-            if f"\t{sentence_number}\n" not in already_in_file:
-                links_to_process[sentence_number] = sentence_number
-            else:
-                skipped_files_count += 1
+    return list(sentence_ids)
 
-    # Log the number of skipped files (sentences)
-    print(f"PAGE {page_number}/{pages_count}: Skipping {skipped_files_count//3} sentences already present in the file.")
 
-    # Process each sentence
-    for sentence_id in links_to_process:
-        add_sentence(str(sentence_id))
+def process_sentences(deck, sentence_ids, already_in_file, tsv_file, executor, audio_executor) -> int:
+    """
+    Fetches sentences and their audio concurrently, and appends them to the import file in the given order.
+
+    :param deck: The deck being built.
+    :param sentence_ids: The sentence numbers (as strings) to add.
+    :param already_in_file: A set containing sentence numbers (as strings) already processed,
+                            updated as rows are written and as sentences are skipped for good.
+    :param tsv_file: The TsvWriter for the import file.
+    :param executor: The pool which processes sentence pages.
+    :param audio_executor: The pool which downloads audio.
+    :return: How many sentences failed and should be retried later.
+             Sentences that are gone or have no wanted translation are recorded in skipped.txt instead,
+             so they do not hold the page back and are not fetched again.
+    """
+    failed_count = 0
+    audio_downloads = []
+    # executor.map yields results in submission order, regardless of which worker finishes first.
+    # Each sentence's audio is queued on the audio pool as soon as its batch has been processed.
+    batch_size = sentence_backend.batch_size
+    batches = [sentence_ids[i:i + batch_size] for i in range(0, len(sentence_ids), batch_size)]
+    rows = (row for batch_rows in executor.map(add_sentences, batches) for row in batch_rows)
+    for num_str, row in zip(sentence_ids, rows):
+        if row is GONE:
+            record_skipped(deck, num_str, already_in_file, "gone")
+        elif row is UNTRANSLATED:
+            record_skipped(deck, num_str, already_in_file, translation_priority_key())
+        elif row is FAILED:
+            failed_count += 1
+        elif row is not None:
+            audio_downloads.append((num_str, row, audio_executor.submit(download_audio, deck, num_str, row[0])))
+
+    # A row is only written once its audio is complete on disk
+    for num_str, (sentence, translations), audio_download in audio_downloads:
+        audio_result = audio_download.result()
+        if audio_result is GONE:
+            record_skipped(deck, num_str, already_in_file, "gone")
+        elif audio_result:
+            append_to_file(num_str, sentence, translations, tsv_file, already_in_file)
+        else:
+            failed_count += 1
+
+    return failed_count
+
+
+def sync_deck(deck: "Deck", executor: ThreadPoolExecutor, audio_executor: ThreadPoolExecutor) -> None:
+    """
+    Tops up a deck with newly recorded audio. The listing shows the newest recordings first,
+    so the sync walks it from page 1 and stops after sync_stop_after consecutive sentences that are already known.
+    The crawl manifest is left alone, since new recordings shift every sentence to a later page.
+
+    :param deck: The deck to top up.
+    :param executor: The pool which processes sentence pages.
+    :param audio_executor: The pool which downloads audio.
+    """
+    setup_filesystem(deck.workspace, deck.tsv_path)
+    # Skipped sentences are known too, otherwise a run of them at the top of the listing would never end the sync
+    already_in_file = load_sentence_ids(deck.tsv_path) | load_skipped_ids(deck.skipped_path)
+
+    known_run = 0
+    added = 0
+    page_number = 1
+    pages_count = 999999
+    with TsvWriter(deck.tsv_path, tsv_flush_rows, tsv_flush_seconds, tsv_fsync) as tsv_file:
+        while page_number < pages_count and known_run < sync_stop_after:
+            # Listing pages change with every new recording, so never trust a cached copy here
+            html = get_html(f'https://tatoeba.org/en/audio/index/{deck.target_lang}?page={page_number}', 0)
+            pages_count = update_pages_count(html, pages_count)
+
+            new_sentences = []
+            for sentence_number in sentence_ids_on_page(html):
+                if str(sentence_number) in already_in_file:
+                    known_run += 1
+                    if known_run >= sync_stop_after:
+                        break
+                else:
+                    known_run = 0
+                    new_sentences.append(str(sentence_number))
+
+            print(f"{deck.target_lang} SYNC PAGE {page_number}: {len(new_sentences)} new sentences.")
+            failed_count = process_sentences(deck, new_sentences, already_in_file, tsv_file, executor, audio_executor)
+            added += len(new_sentences) - failed_count
+            page_number += 1
+
+    print(f"{deck.target_lang}: Sync done after {page_number - 1} pages, {added} new sentences processed.")
 
 
 
@@ -204,58 +415,541 @@ def process_html_string(html: str) -> str:
     processed_html = html.replace("&#039;", "'").replace("&quot;", '"')
     return processed_html
 
+# The sentence JSON sits in the ng-init attribute that follows these markers, in this order,
+# and ends right before the first ", [{" after them.
+SENTENCE_JSON_MARKERS = (b'<div ng-cloak flex', b'sentence-and-translations', b'ng-init="vm.init([],')
+SENTENCE_JSON_END = b'}, [{'
+
+class SentenceJsonScanner:
+    """
+    Finds the sentence JSON in a page that arrives in chunks, without rescanning bytes it has already looked at.
+    """
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.stage = 0
+        self.position = 0
+
+    def feed(self, chunk: bytes) -> Optional[int]:
+        """
+        Adds a chunk of the page.
+
+        :param chunk: The next bytes of the page.
+        :return: The length of the page prefix that contains the whole JSON, once it has been seen, otherwise None.
+        """
+        self.buffer += chunk
+        while self.stage < len(SENTENCE_JSON_MARKERS):
+            marker = SENTENCE_JSON_MARKERS[self.stage]
+            found = self.buffer.find(marker, self.position)
+            if found == -1:
+                # Keep the tail in case the marker straddles two chunks
+                self.position = max(self.position, len(self.buffer) - len(marker) + 1)
+                return None
+            self.position = found + len(marker)
+            self.stage += 1
+            if self.stage == len(SENTENCE_JSON_MARKERS):
+                self.json_start = self.position
+
+        found = self.buffer.find(SENTENCE_JSON_END, self.position)
+        if found == -1:
+            self.position = max(self.position, len(self.buffer) - len(SENTENCE_JSON_END) + 1)
+            return None
+        self.json_end = found + 1
+        return found + len(SENTENCE_JSON_END)
+
+    def json(self) -> str:
+        """
+        Returns the JSON found by feed, with HTML entities replaced.
+        """
+        return process_html_string(self.buffer[self.json_start:self.json_end].decode('utf-8'))
+
 # Function to extract JSON data for a sentence from the HTML page
 def extract_json_sentence(html: str) -> str:
     """
-    Extracts the JSON containing sentence and translations from the HTML content using a regular expression.
+    Extracts the JSON containing sentence and translations from the HTML content.
 
     :param html: The HTML content as a string.
     :return: The JSON string extracted from the HTML.
     """
-    pattern = '<div ng-cloak flex.+?sentence-and-translations.+?ng-init="vm.init\(\[\]\,(.+?}), \[\{'
-    json_data_match = re.findall(pattern, process_html_string(html), re.DOTALL)
-    return json_data_match[0] if json_data_match else ''
+    scanner = SentenceJsonScanner()
+    return scanner.json() if scanner.feed(html.encode('utf-8')) is not None else ''
+
+def fetch_json_sentence(url: str) -> str:
+    """
+    Downloads a sentence page only as far as the end of its sentence JSON, and extracts the JSON.
+    The downloaded prefix is what goes into the response cache, since nothing after it is ever used.
+    An expired cached copy is revalidated with its ETag or Last-Modified date, and reused if the server answers 304.
 
-# Function to add a sentence and its translations to a file
-def add_sentence(num_str: str) -> None:
+    :param url: The URL of the sentence page.
+    :return: The JSON string, or an empty string if the page does not contain one.
+    :raises HTTPError: An error from the server if the response code is not 200.
+    :raises URLError: A failure to reach the server.
+    """
+    cache = get_response_cache()
+    cached = cache.load(url)
+    if cached is not None and time.time() - cached[0]["fetched"] < sentence_cache_ttl:
+        return extract_json_sentence(cached[1].decode('utf-8'))
+
+    # Ask the server whether our stale copy is still good
+    request_headers = revalidation_headers(cached[0]) if cached is not None else {}
+
+    for attempt in range(max_retries + 1):
+        final_url, response = http_pool.open(url, request_headers)
+        if response.status == 304 and cached is not None:
+            response.read()
+            http_pool.release(final_url, response)
+            cache.store(url, response.headers, None, cached[0])
+            return extract_json_sentence(cached[1].decode('utf-8'))
+        decompressor = Decompressor(response.headers.get("Content-Encoding", ""))
+        scanner = SentenceJsonScanner()
+        prefix_length = None
+        try:
+            while prefix_length is None:
+                chunk = response.read(16384)
+                if not chunk:
+                    break
+                prefix_length = scanner.feed(decompressor.decompress(chunk))
+        except (http.client.HTTPException, OSError, zlib.error) as e:
+            http_pool.release(final_url, response)
+            if attempt == max_retries:
+                raise URLError(e)
+            continue
+        # Stopping early leaves the rest of the body unread, and release closes the connection in that case.
+        # response.length is what is left of a body with a Content-Length, and None for a chunked one.
+        if prefix_length is not None and response.length is not None and response.length <= drain_max_bytes:
+            try:
+                response.read()
+            except (http.client.HTTPException, OSError):
+                pass
+        http_pool.release(final_url, response)
+        break
+
+    # A page without the JSON may be an error page or a new layout, so it is not cached and is fetched again next time
+    if prefix_length is None:
+        return ''
+    cache.store(url, response.headers, bytes(scanner.buffer[:prefix_length]))
+    return scanner.json()
+
+# Returned by add_sentence when a sentence could not be processed, as opposed to being deliberately skipped.
+# A unique object, so it is never mistaken for a row.
+FAILED = object()
+
+# Returned by the sentence backends, add_sentence and download_audio when the server answered 404 or 410,
+# so retrying would not help and the sentence is skipped for good.
+GONE = object()
+
+# Returned by add_sentence when none of the translations in translation_priority exist for a sentence.
+UNTRANSLATED = object()
+
+def is_gone(error: Exception) -> bool:
     """
-    Retrieves a sentence and its translations from Tatoeba, downloads the audio, and appends the data to a file.
+    Tells whether an error means the resource will never be available, as opposed to a failure worth retrying.
+    Other client errors are not trusted, since a 401 or 403 is also what a temporary block looks like.
+    """
+    return isinstance(error, HTTPError) and error.code in (404, 410)
+
+class HtmlSentenceBackend:
+    """
+    Gets sentence JSON by streaming the rendered sentences/show page, one sentence per request.
+    """
+
+    batch_size = 1
+
+    def fetch(self, num_strs: List[str]) -> Dict[str, str]:
+        """
+        Fetches the JSON of several sentences.
+
+        :param num_strs: The sentence numbers as strings.
+        :return: A dictionary from sentence number to JSON string, which is empty if the page had none,
+                 or GONE if the page does not exist. Sentences which could not be fetched are left out.
+        """
+        json_sentences = {}
+        for num_str in num_strs:
+            # Decks of different languages can ask for the same page at once, in which case it is only fetched once
+            url = 'https://tatoeba.org/eng/sentences/show/' + num_str
+            try:
+                json_sentences[num_str] = fetch_once(url, lambda: fetch_json_sentence(url))
+            except Exception as e:
+                if is_gone(e):
+                    json_sentences[num_str] = GONE
+                print(f"An error occurred while fetching sentence {num_str}: {e}")
+        return json_sentences
+
+class JsonApiSentenceBackend:
+    """
+    Gets sentence JSON from a structured API endpoint, which is a fraction of the size of the rendered page.
+    If batch_url is set, up to batch_size sentences are looked up per request.
+    Any sentence the API cannot provide is fetched through the HTML backend instead.
+    """
+
+    def __init__(self, sentence_url: str, batch_url: Optional[str], batch_size: int) -> None:
+        self.sentence_url = sentence_url
+        self.batch_url = batch_url
+        self.batch_size = batch_size if batch_url else 1
+        self.fallback = HtmlSentenceBackend()
+
+    def fetch(self, num_strs: List[str]) -> Dict[str, str]:
+        """
+        Fetches the JSON of several sentences, in the same shape as HtmlSentenceBackend.fetch.
+        """
+        json_sentences = {}
+        try:
+            if len(num_strs) > 1:
+                body = json.loads(get_html(self.batch_url.format(ids=",".join(num_strs))))
+                sentences = body.get("data", body) if isinstance(body, dict) else body
+            else:
+                body = json.loads(get_html(self.sentence_url.format(id=num_strs[0])))
+                sentences = [body.get("data", body)]
+            for sentence in sentences:
+                normalized = normalize_api_sentence(sentence)
+                if normalized is not None:
+                    json_sentences[str(sentence["id"])] = normalized
+        except Exception as e:
+            print(f"  The sentence API failed for {', '.join(num_strs)}, falling back to sentence pages: {e}")
+
+        missing = [num_str for num_str in num_strs if num_str not in json_sentences]
+        if missing:
+            json_sentences.update(self.fallback.fetch(missing))
+        return json_sentences
+
+def normalize_api_sentence(sentence: Any) -> Optional[str]:
+    """
+    Checks that a sentence from the API has the shape select_translation expects,
+    where translations is a list of direct translations followed by a list of indirect ones.
+
+    :param sentence: A parsed sentence object from the API.
+    :return: The sentence as a JSON string, or None if it is not usable.
+    """
+    if not isinstance(sentence, dict) or "id" not in sentence or "text" not in sentence:
+        return None
+    translations = sentence.get("translations")
+    if not isinstance(translations, list) or not all(isinstance(group, list) for group in translations):
+        return None
+    for group_index, group in enumerate(translations):
+        for translation in group:
+            translation.setdefault("isDirect", group_index == 0)
+    return json.dumps({"text": sentence["text"], "translations": translations})
+
+def make_sentence_backend(name: str) -> Union[HtmlSentenceBackend, JsonApiSentenceBackend]:
+    """
+    Creates the sentence backend selected by name, either "api" or "html".
+    """
+    if name == "api":
+        return JsonApiSentenceBackend(api_sentence_url, api_batch_url, api_batch_size)
+    return HtmlSentenceBackend()
+
+sentence_backend = make_sentence_backend(sentence_backend_name)
+
+def add_sentences(num_strs: List[str]) -> List[Union[Tuple[str, List[str]], object, None]]:
+    """
+    Retrieves a batch of sentences and their translations from Tatoeba through the sentence backend.
+    Safe to call from worker threads.
+
+    :param num_strs: The sentence numbers as strings.
+    :return: The result of add_sentence for each sentence, in the same order.
+    """
+    json_sentences = sentence_backend.fetch(num_strs)
+    return [add_sentence(num_str, json_sentences.get(num_str)) for num_str in num_strs]
+
+# Function to turn a sentence and its translations into a row, ready to be added to the file
+def add_sentence(num_str: str, json_sentence: Optional[str]) -> Union[Tuple[str, List[str]], object, None]:
+    """
+    Selects the translations of a sentence. The audio is downloaded separately by download_audio,
+    and the caller is responsible for appending the row to the file.
 
     :param num_str: The sentence number as a string.
+    :param json_sentence: The sentence JSON from the backend, an empty string if there was none,
+                          GONE if the sentence does not exist, or None if fetching failed.
+    :return: A tuple of the sentence and its selected translations, None if the page had no sentence JSON,
+             UNTRANSLATED if it has no wanted translation, GONE if it no longer exists,
+             or FAILED if an error occurred and the sentence should be retried later.
     """
+    if json_sentence is None:
+        return FAILED
+    if json_sentence is GONE:
+        print(f"  {num_str}: The sentence no longer exists! Skipping for good...")
+        return GONE
     try:
-        # Get the HTML content from Tatoeba
-        html = get_html('https://tatoeba.org/eng/sentences/show/' + num_str)
-        json_sentence = extract_json_sentence(html)
-
         # If no JSON data is found, skip the sentence
         if not json_sentence:
             print(f"  {num_str}: No JSON data found! Skipping...")
-            return
+            return None
 
         # Select the best translation based on the priority
         sentence, translations = select_translation(json_sentence, translation_priority)
 
         # If no translations are found, skip the sentence
-        if not translations:
+        if not any(translations):
             print(f"  {num_str}: No known-language translations found! Skipping...")
-            return
-        
-        # Handle audio download and storage
-        audiourl = f'https://audio.tatoeba.org/sentences/{target_lang}/{num_str}.mp3'
-        audiopath = os.path.join(workspace, f"{num_str}.mp3")
-        success_text = f"{num_str}: {sentence}"
-
-        if os.path.exists(audiopath):
-            print(f"- {success_text}")
-        else:
-            urllib.request.urlretrieve(audiourl, audiopath)
-            print(f"a {success_text}")
+            return UNTRANSLATED
 
-        # Append the data to the file
-        append_to_file(num_str, sentence, translations, tsv_path)
+        return sentence, translations
     except Exception as e:
         print(f"An error occurred while processing sentence {num_str}: {e}")
+        return FAILED
+
+def audio_url(deck: "Deck", num_str: str) -> str:
+    """
+    Returns the URL of a sentence's audio on tatoeba.
+    """
+    return f'https://audio.tatoeba.org/sentences/{deck.target_lang}/{num_str}.mp3'
+
+def download_audio(deck: "Deck", num_str: str, sentence: str) -> Union[bool, object]:
+    """
+    Downloads the audio of a sentence into the deck's workspace, unless it is already there.
+
+    The file is written to a .part name and only renamed to its final name once its size matches what the server
+    announced, so an existing mp3 is always complete. An interrupted download is resumed with a Range request.
+
+    :param deck: The deck the sentence belongs to.
+    :param num_str: The sentence number as a string.
+    :param sentence: The sentence text, only used for logging.
+    :return: True if the audio is complete on disk, GONE if the server has no audio for the sentence, otherwise False.
+    """
+    audiourl = audio_url(deck, num_str)
+    audiopath = os.path.join(deck.workspace, f"{num_str}.mp3")
+    partpath = audiopath + ".part"
+    success_text = f"{num_str}: {sentence}"
+
+    if os.path.exists(audiopath):
+        print(f"- {success_text}")
+        return True
+
+    try:
+        resume_from = os.path.getsize(partpath) if os.path.exists(partpath) else 0
+        # Compressed transfer would make byte ranges and Content-Length refer to the wrong bytes
+        headers = {"Accept-Encoding": "identity"}
+        if resume_from:
+            headers["Range"] = f"bytes={resume_from}-"
+        try:
+            final_url, response = http_pool.open(audiourl, headers)
+        except HTTPError as e:
+            if e.code != 416:
+                raise
+            # The range is past the end of the file, so the partial file is not a prefix of it. Start over.
+            os.remove(partpath)
+            return download_audio(deck, num_str, sentence)
+
+        if response.status == 206:
+            # Content-Range looks like "bytes 1000-4999/5000"
+            expected_size = int(response.headers.get("Content-Range", "").rpartition("/")[2] or -1)
+            mode = "ab"
+        else:
+            resume_from = 0
+            expected_size = int(response.headers.get("Content-Length") or -1)
+            mode = "wb"
+
+        try:
+            with open(partpath, mode) as part_file:
+                while True:
+                    chunk = response.read(65536)
+                    if not chunk:
+                        break
+                    part_file.write(chunk)
+        finally:
+            http_pool.release(final_url, response)
+
+        size = os.path.getsize(partpath)
+        if expected_size >= 0 and size != expected_size:
+            print(f"  {num_str}: Audio is {size} bytes but should be {expected_size}, it will be resumed next time.")
+            return False
+        os.replace(partpath, audiopath)
+        print(f"{'r' if resume_from else 'a'} {success_text}")
+        return True
+    except Exception as e:
+        print(f"An error occurred while downloading audio for sentence {num_str}: {e}")
+        return GONE if is_gone(e) else False
+
+def looks_like_mp3(path: str) -> bool:
+    """
+    Checks that a file starts like an mp3, either with an ID3 tag or with an MPEG audio frame header.
+
+    :param path: The path to the file.
+    :return: True if the file looks like an mp3.
+    """
+    try:
+        with open(path, "rb") as audio_file:
+            header = audio_file.read(3)
+    except OSError:
+        return False
+    return header == b"ID3" or (len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0)
+
+def audio_size_on_server(audiourl: str) -> int:
+    """
+    Asks the server how large an audio file is, with a one byte Range request so the file itself is not downloaded.
+
+    :param audiourl: The URL of the audio file.
+    :return: The size in bytes, or -1 if the server did not say.
+    :raises HTTPError: An error from the server if the response code is not 200 or 206.
+    :raises URLError: A failure to reach the server.
+    """
+    # Compressed transfer would make Content-Length refer to the wrong bytes
+    final_url, response = http_pool.open(audiourl, {"Accept-Encoding": "identity", "Range": "bytes=0-0"})
+    try:
+        if response.status == 206:
+            # Content-Range looks like "bytes 0-0/5000", the total may be "*" if the server does not know it
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            response.read()
+            return int(total) if total.isdigit() else -1
+        # The server ignored the range and is sending the whole file, which is not worth reading just to keep the connection
+        return int(response.headers.get("Content-Length") or -1)
+    finally:
+        http_pool.release(final_url, response)
+
+def audio_is_intact(deck: "Deck", num_str: str) -> bool:
+    """
+    Checks that a sentence's audio is on disk, starts like an mp3, and is as large as the file on the server.
+    If the server cannot be asked, a file that looks like an mp3 is trusted.
+
+    :param deck: The deck the sentence belongs to.
+    :param num_str: The sentence number as a string.
+    :return: True if the audio does not need to be downloaded again.
+    """
+    audiopath = os.path.join(deck.workspace, f"{num_str}.mp3")
+    if not looks_like_mp3(audiopath):
+        print(f"  {num_str}: Audio is missing or corrupt, downloading again.")
+        return False
+
+    try:
+        expected_size = audio_size_on_server(audio_url(deck, num_str))
+    except Exception as e:
+        print(f"  {num_str}: Could not check the audio size with the server: {e}")
+        return True
+    size = os.path.getsize(audiopath)
+    if expected_size >= 0 and size != expected_size:
+        print(f"  {num_str}: Audio is {size} bytes but should be {expected_size}, downloading again.")
+        return False
+    return True
+
+def verify_audio(deck: "Deck") -> None:
+    """
+    Checks the audio of every sentence in a deck's import file and downloads again any that is missing, corrupt
+    or truncated.
+
+    :param deck: The deck to verify.
+    """
+    setup_filesystem(deck.workspace, deck.tsv_path)
+    sentences = []
+    with open(deck.tsv_path, 'r', encoding='utf-8') as tsv_file:
+        for line in tsv_file:
+            fields = line.rstrip("\n").split(separator)
+            if len(fields) > 2:
+                sentences.append((fields[-1], fields[1]))
+
+    with ThreadPoolExecutor(max_workers=audio_workers) as audio_executor:
+        # Every size check is a request, so they share the audio pool and the rate limit like downloads do
+        intact = list(audio_executor.map(lambda sentence: audio_is_intact(deck, sentence[0]), sentences))
+        bad = [sentence for sentence, is_intact in zip(sentences, intact) if not is_intact]
+        for num_str, sentence in bad:
+            audiopath = os.path.join(deck.workspace, f"{num_str}.mp3")
+            if os.path.exists(audiopath):
+                os.remove(audiopath)
+        print(f"{deck.target_lang}: Verified {len(sentences)} audio files, {len(bad)} need to be downloaded again.")
+
+        results = list(audio_executor.map(lambda sentence: download_audio(deck, *sentence), bad))
+    if GONE in results:
+        print(f"{results.count(GONE)} audio files no longer exist on the server.")
+    if False in results:
+        print(f"{results.count(False)} audio files could not be downloaded. Run the verification again later.")
+
+
+
+
+def postprocess_audio(deck: "Deck", codec: str, bitrate: str) -> None:
+    """
+    Loudness-normalises every mp3 of a deck with ffmpeg, optionally transcoding to Opus, in a process pool.
+    The originals are kept, and the import file is rewritten to point at the processed files.
+    A file is skipped when its source hash and the settings match what was recorded the last time it was processed.
+
+    :param deck: The deck to process.
+    :param codec: "mp3" or "opus".
+    :param bitrate: The target bitrate for ffmpeg, e.g. "32k".
+    """
+    setup_filesystem(deck.workspace, deck.tsv_path)
+    state_path = os.path.join(deck.workspace, "postprocess.json")
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as state_file:
+            state = json.load(state_file)
+
+    settings = f"{codec} {bitrate} I={postprocess_loudness}"
+    extension = "opus" if codec == "opus" else "mp3"
+    jobs = []
+    outputs = {}
+    for num_str in sorted(load_sentence_ids(deck.tsv_path), key=int):
+        source = os.path.join(deck.workspace, f"{num_str}.mp3")
+        if not os.path.exists(source):
+            continue
+        output_name = f"{num_str}.norm.{extension}"
+        outputs[num_str] = output_name
+        jobs.append((num_str, source, os.path.join(deck.workspace, output_name), settings, state.get(num_str)))
+
+    print(f"{deck.target_lang}: Post-processing {len(jobs)} audio files to {settings}...")
+    processed = skipped = failed = 0
+    with ProcessPoolExecutor(max_workers=postprocess_workers) as process_executor:
+        results = process_executor.map(postprocess_one_audio, jobs, [codec] * len(jobs), [bitrate] * len(jobs), chunksize=16)
+        for (num_str, _, _, _, _), (status, record) in zip(jobs, results):
+            if status == "skipped":
+                skipped += 1
+            elif status == "processed":
+                processed += 1
+                state[num_str] = record
+            else:
+                failed += 1
+                del outputs[num_str]
+                print(f"  {num_str}: {record}")
+    print(f"{deck.target_lang}: {processed} processed, {skipped} already up to date, {failed} failed.")
+
+    write_atomically(state_path, json.dumps(state).encode('utf-8'))
+    rewrite_sound_references(deck.tsv_path, outputs)
+
+def postprocess_one_audio(job: Tuple[str, str, str, str, Optional[dict]], codec: str, bitrate: str) -> Tuple[str, Any]:
+    """
+    Processes one audio file. Runs in a worker process.
+
+    :param job: The sentence number, the source path, the output path, the settings string and the previous record.
+    :param codec: "mp3" or "opus".
+    :param bitrate: The target bitrate for ffmpeg.
+    :return: A tuple of "skipped", "processed" or "failed", and the new record or an error message.
+    """
+    num_str, source, output, settings, previous = job
+    with open(source, 'rb') as source_file:
+        source_hash = hashlib.sha256(source_file.read()).hexdigest()
+    record = {"source_hash": source_hash, "settings": settings}
+    if previous == record and os.path.exists(output):
+        return "skipped", previous
+
+    codec_arguments = ["-c:a", "libopus", "-b:a", bitrate] if codec == "opus" else ["-c:a", "libmp3lame", "-b:a", bitrate]
+    temp_output = output + ".tmp." + os.path.splitext(output)[1].lstrip(".")
+    command = ["ffmpeg", "-nostdin", "-y", "-v", "error", "-i", source,
+               "-af", f"loudnorm=I={postprocess_loudness}:TP=-1.5:LRA=11", "-ar", "48000"] + codec_arguments + [temp_output]
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    except (subprocess.CalledProcessError, OSError) as e:
+        if os.path.exists(temp_output):
+            os.remove(temp_output)
+        return "failed", getattr(e, "stderr", None) or str(e)
+    os.replace(temp_output, output)
+    return "processed", record
+
+def rewrite_sound_references(tsv_path: str, outputs: Dict[str, str]) -> None:
+    """
+    Points the [sound:...] field of every row at its processed file, in one streaming pass over the import file.
+    Rows are matched by their sentence ID, so rows pointing at an earlier processed file are updated too.
+
+    :param tsv_path: The path to the TSV file.
+    :param outputs: A dictionary from sentence number to the processed file name.
+    """
+    temp_path = tsv_path + ".tmp"
+    with open(tsv_path, 'r', encoding='utf-8') as tsv_file, open(temp_path, 'w', encoding='utf-8') as temp_file:
+        for line in tsv_file:
+            fields = line.rstrip("\n").split(separator)
+            output_name = outputs.get(fields[-1])
+            if output_name and fields[0].startswith("[sound:"):
+                fields[0] = f"[sound:{output_name}]"
+                line = separator.join(fields) + "\n"
+            temp_file.write(line)
+    os.replace(temp_path, tsv_path)
 
 
 
@@ -302,6 +996,142 @@ def select_translation_from_sublist(json_data: Any, translation_priority_sublist
 
 
 
+# Offline ingestion from the Tatoeba CSV exports (https://tatoeba.org/en/downloads)
+#
+# Instead of scraping one sentence page at a time, this reads the extracted sentences.csv, links.csv and
+# sentences_with_audio.csv files and joins them locally. Only the mp3s are downloaded.
+# Every file is streamed several times rather than loaded, so memory stays proportional to the number of
+# target-language sentences with audio, not to the size of the whole dump.
+
+def read_export(path: str, max_fields: int) -> Iterator[List[str]]:
+    """
+    Streams the rows of a tab-separated Tatoeba export.
+    The exports are not quoted, so sentence text may contain any character other than a tab or newline.
+
+    :param path: The path to the export file.
+    :param max_fields: How many fields to split each row into; the last field keeps the rest of the line.
+    :return: An iterator over the fields of each row.
+    """
+    with open(path, 'r', encoding='utf-8') as export_file:
+        for line in export_file:
+            fields = line.rstrip("\n").split("\t", max_fields - 1)
+            if len(fields) == max_fields:
+                yield fields
+
+def build_language_index(sentences_path: str) -> Tuple[array, List[str]]:
+    """
+    Builds a compact index from sentence ID to language, stored as two bytes per sentence ID.
+
+    :param sentences_path: The path to sentences.csv.
+    :return: A tuple of the index array and the list of language codes its values refer to.
+             Code 0 is reserved for unknown IDs.
+    """
+    languages = [""]
+    language_codes = {"": 0}
+    language_index = array('H')
+    for sentence_id, lang, _ in read_export(sentences_path, 3):
+        sentence_id = int(sentence_id)
+        if sentence_id >= len(language_index):
+            language_index.extend(array('H', bytes(2 * (sentence_id + 1 - len(language_index)))))
+        if lang not in language_codes:
+            language_codes[lang] = len(languages)
+            languages.append(lang)
+        language_index[sentence_id] = language_codes[lang]
+    return language_index, languages
+
+def ingest_exports(deck: "Deck", exports_dir: str) -> None:
+    """
+    Builds a deck's import file from local Tatoeba exports, applying the same translation_priority rules as the scraper.
+
+    :param deck: The deck to build.
+    :param exports_dir: The directory containing the extracted sentences.csv, links.csv and sentences_with_audio.csv.
+    """
+    setup_filesystem(deck.workspace, deck.tsv_path)
+    print(f"Using translation priority {translation_priority}")
+
+    sentences_path = os.path.join(exports_dir, "sentences.csv")
+    links_path = os.path.join(exports_dir, "links.csv")
+    audio_path = os.path.join(exports_dir, "sentences_with_audio.csv")
+    already_in_file = load_sentence_ids(deck.tsv_path) | load_skipped_ids(deck.skipped_path)
+
+    print("Indexing sentence languages...")
+    language_index, languages = build_language_index(sentences_path)
+    def lang_of(sentence_id: int) -> str:
+        return languages[language_index[sentence_id]] if sentence_id < len(language_index) else ""
+    wanted_languages = {language for sublist in translation_priority for language, _ in sublist}
+
+    print("Finding sentences with audio...")
+    targets = set()
+    for fields in read_export(audio_path, 2):
+        sentence_id = int(fields[0])
+        if lang_of(sentence_id) == deck.target_lang and str(sentence_id) not in already_in_file:
+            targets.add(sentence_id)
+    print(f"{len(targets)} new {deck.target_lang} sentences with audio.")
+
+    # Direct links of the targets, in any language since they are also the first hop of indirect translations
+    print("Joining direct translations...")
+    direct = {}
+    for source_id, translation_id in read_export(links_path, 2):
+        source_id = int(source_id)
+        if source_id in targets:
+            direct.setdefault(source_id, []).append(int(translation_id))
+    first_hops = {translation_id for translation_ids in direct.values() for translation_id in translation_ids}
+
+    # Links of the first hops, kept only if they lead to a language we might use
+    print("Joining indirect translations...")
+    second_hops = {}
+    for source_id, translation_id in read_export(links_path, 2):
+        source_id = int(source_id)
+        if source_id in first_hops:
+            translation_id = int(translation_id)
+            if lang_of(translation_id) in wanted_languages:
+                second_hops.setdefault(source_id, []).append(translation_id)
+
+    # Every sentence whose text we actually need
+    needed = set(targets)
+    for translation_ids in direct.values():
+        needed.update(translation_id for translation_id in translation_ids if lang_of(translation_id) in wanted_languages)
+    for translation_ids in second_hops.values():
+        needed.update(translation_ids)
+
+    print("Reading sentence texts...")
+    texts = {}
+    for sentence_id, _, text in read_export(sentences_path, 3):
+        sentence_id = int(sentence_id)
+        if sentence_id in needed:
+            texts[sentence_id] = text
+
+    # Shape the joined data like the JSON on a sentence page, so that select_translation_from_sublist applies as-is
+    rows = []
+    for sentence_id in sorted(targets):
+        direct_ids = direct.get(sentence_id, [])
+        indirect_ids = []
+        for first_hop in direct_ids:
+            for translation_id in second_hops.get(first_hop, []):
+                if translation_id != sentence_id and translation_id not in direct_ids and translation_id not in indirect_ids:
+                    indirect_ids.append(translation_id)
+        json_data = {'text': texts[sentence_id], 'translations': [
+            [{'lang': lang_of(i), 'text': texts[i], 'isDirect': True} for i in direct_ids if i in texts],
+            [{'lang': lang_of(i), 'text': texts[i], 'isDirect': False} for i in indirect_ids if i in texts],
+        ]}
+        translations = [select_translation_from_sublist(json_data, sublist) for sublist in translation_priority]
+        if any(translations):
+            rows.append((str(sentence_id), json_data['text'], translations))
+    print(f"{len(rows)} sentences have a known-language translation. Downloading audio...")
+
+    # Download concurrently, but write rows out in ID order
+    with ThreadPoolExecutor(max_workers=audio_workers) as audio_executor, \
+         TsvWriter(deck.tsv_path, tsv_flush_rows, tsv_flush_seconds, tsv_fsync) as tsv_file:
+        downloads = audio_executor.map(lambda row: download_audio(deck, row[0], row[1]), rows)
+        for (num_str, sentence, translations), downloaded in zip(rows, downloads):
+            if downloaded is GONE:
+                record_skipped(deck, num_str, already_in_file, "gone")
+            elif downloaded:
+                append_to_file(num_str, sentence, translations, tsv_file, already_in_file)
+
+
+
+
 
 
 
@@ -322,6 +1152,326 @@ def select_translation_from_sublist(json_data: Any, translation_priority_sublist
 
 # Helper Functions
 
+class RateLimiter:
+    """
+    Spaces out requests so that no more than a given number are started per second, across all threads.
+    """
+
+    def __init__(self, per_second: float) -> None:
+        self.interval = 1.0 / per_second if per_second > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        """
+        Blocks until the caller is allowed to send its next request.
+        """
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+rate_limiter = RateLimiter(requests_per_second)
+
+class ConnectionPool:
+    """
+    Keeps one persistent HTTP connection per host and per thread, so consecutive requests skip the TCP and TLS handshakes.
+    Requests ask for gzip/deflate transfer, follow redirects, and are retried with exponential backoff and jitter.
+    """
+
+    retryable_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(self, retries: int, backoff: float) -> None:
+        self.retries = retries
+        self.backoff = backoff
+        self.local = threading.local()
+
+    def connection(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        """
+        Returns this thread's open connection to a host, creating it if needed.
+        """
+        connections = self.local.__dict__.setdefault("connections", {})
+        key = (scheme, netloc)
+        if key not in connections:
+            connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            connections[key] = connection_class(netloc, timeout=60)
+        return connections[key]
+
+    def drop(self, scheme: str, netloc: str) -> None:
+        """
+        Closes and forgets this thread's connection to a host, after an error left it in an unknown state.
+        """
+        connection = self.local.__dict__.get("connections", {}).pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def release(self, url: str, response: http.client.HTTPResponse) -> None:
+        """
+        Hands a connection back after a response. It is only kept if the body was read to the end,
+        since an unread body would be mistaken for the start of the next response.
+        """
+        if not response.isclosed() or response.will_close:
+            parts = urllib.parse.urlsplit(url)
+            self.drop(parts.scheme, parts.netloc)
+
+    def get(self, url: str, headers: Optional[dict] = None) -> Tuple[int, http.client.HTTPMessage, bytes]:
+        """
+        Performs a GET request and returns the decompressed body.
+
+        :param url: The URL to fetch.
+        :param headers: Extra request headers.
+        :return: A tuple of the status code, the response headers and the body.
+        :raises HTTPError: If the server answered with an error status, after any retries.
+        :raises URLError: If the server could not be reached, after any retries.
+        """
+        for attempt in range(self.retries + 1):
+            final_url, response = self.open(url, headers)
+            try:
+                body = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                self.release(final_url, response)
+                if attempt == self.retries:
+                    raise URLError(e)
+                continue
+            self.release(final_url, response)
+            return response.status, response.headers, decompress(body, response.headers.get("Content-Encoding", ""))
+
+    def open(self, url: str, headers: Optional[dict] = None) -> Tuple[str, http.client.HTTPResponse]:
+        """
+        Performs a GET request, following redirects, and returns the response with its body still unread.
+        The caller must read the (possibly compressed) body and then call release.
+
+        :param url: The URL to fetch.
+        :param headers: Extra request headers.
+        :return: A tuple of the final URL after redirects and the response.
+        :raises HTTPError: If the server answered with an error status, after any retries.
+        :raises URLError: If the server could not be reached, after any retries.
+        """
+        for redirect in range(5):
+            response = self.send(url, headers)
+            if response.status in (301, 302, 303, 307, 308) and response.headers.get("Location"):
+                response.read()
+                self.release(url, response)
+                url = urllib.parse.urljoin(url, response.headers["Location"])
+                continue
+            if response.status >= 400:
+                response.read()
+                self.release(url, response)
+                raise HTTPError(url, response.status, response.reason, response.headers, None)
+            return url, response
+        raise URLError(f"Too many redirects for {url}")
+
+    def exchange(self, scheme: str, netloc: str, path: str, headers: dict) -> http.client.HTTPResponse:
+        """
+        Sends a GET request on this thread's connection to a host and waits for the response headers.
+        A kept-alive connection may have been closed by the server while it sat idle. If sending on a reused connection
+        fails like that, the request is sent again straight away on a new one, since this is not worth a backoff.
+        """
+        reused = (scheme, netloc) in self.local.__dict__.get("connections", {})
+        connection = self.connection(scheme, netloc)
+        try:
+            connection.request("GET", path, headers=headers)
+            return connection.getresponse()
+        except (ConnectionResetError, BrokenPipeError):
+            # RemoteDisconnected, which http.client raises when the server hung up, is a ConnectionResetError
+            if not reused:
+                raise
+            self.drop(scheme, netloc)
+        connection = self.connection(scheme, netloc)
+        connection.request("GET", path, headers=headers)
+        return connection.getresponse()
+
+    def send(self, url: str, headers: Optional[dict]) -> http.client.HTTPResponse:
+        """
+        Sends a single GET request without following redirects, retrying until the response headers arrive.
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+        request_headers = {"Accept-Encoding": "gzip, deflate", "User-Agent": "Tatoeba-To-Anki"}
+        request_headers.update(headers or {})
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.backoff * 2 ** (attempt - 1)
+                time.sleep(delay + random.uniform(0, delay))
+            rate_limiter.wait()
+            try:
+                response = self.exchange(parts.scheme, parts.netloc, path, request_headers)
+                if response.status in self.retryable_statuses and attempt < self.retries:
+                    response.read()
+                    self.release(url, response)
+                    continue
+            except (http.client.HTTPException, OSError) as e:
+                self.drop(parts.scheme, parts.netloc)
+                if attempt == self.retries:
+                    raise URLError(e)
+                continue
+            return response
+
+def decompress(body: bytes, content_encoding: str) -> bytes:
+    """
+    Undoes a gzip or deflate Content-Encoding.
+
+    :param body: The raw response body.
+    :param content_encoding: The value of the Content-Encoding header.
+    :return: The decoded body.
+    """
+    content_encoding = content_encoding.strip().lower()
+    if content_encoding == "gzip":
+        return gzip.decompress(body)
+    if content_encoding == "deflate":
+        # Some servers send raw deflate data without the zlib wrapper
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+class Decompressor:
+    """
+    Undoes a gzip or deflate Content-Encoding incrementally, one chunk at a time.
+    """
+
+    def __init__(self, content_encoding: str) -> None:
+        content_encoding = content_encoding.strip().lower()
+        if content_encoding == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif content_encoding == "deflate":
+            self.decompressor = zlib.decompressobj()
+        else:
+            self.decompressor = None
+
+    def decompress(self, chunk: bytes) -> bytes:
+        return self.decompressor.decompress(chunk) if self.decompressor else chunk
+
+http_pool = ConnectionPool(max_retries, retry_backoff)
+
+class ResponseCache:
+    """
+    An on-disk cache of response bodies keyed by URL, stored gzip-compressed, with least-recently-used eviction.
+    Each entry is a .gz body next to a .json file holding the URL, validators and fetch time.
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(".gz"))
+
+    def paths(self, url: str) -> Tuple[str, str]:
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + ".gz"), os.path.join(self.directory, key + ".json")
+
+    def load(self, url: str) -> Optional[Tuple[dict, bytes]]:
+        """
+        Returns the cached metadata and body for a URL, or None if it is not cached.
+        """
+        body_path, meta_path = self.paths(url)
+        try:
+            with open(meta_path, 'r') as meta_file:
+                meta = json.load(meta_file)
+            with open(body_path, 'rb') as body_file:
+                body = gzip.decompress(body_file.read())
+            if meta.get("url") != url:
+                return None
+            # Touching the body marks the entry as recently used. Another thread may have just evicted it.
+            os.utime(body_path)
+        except (OSError, ValueError, EOFError):
+            return None
+        return meta, body
+
+    def store(self, url: str, headers: http.client.HTTPMessage, body: Optional[bytes], previous: Optional[dict] = None) -> None:
+        """
+        Caches a response body, or just refreshes the fetch time of an existing entry if body is None.
+        Validators missing from the new headers are carried over from the previous metadata.
+        """
+        body_path, meta_path = self.paths(url)
+        previous = previous or {}
+        meta = {"url": url, "fetched": time.time(),
+                "etag": headers.get("ETag") or previous.get("etag"),
+                "last_modified": headers.get("Last-Modified") or previous.get("last_modified")}
+        with self.lock:
+            if body is not None:
+                old_size = os.path.getsize(body_path) if os.path.exists(body_path) else 0
+                write_atomically(body_path, gzip.compress(body))
+                self.total_bytes += os.path.getsize(body_path) - old_size
+            write_atomically(meta_path, json.dumps(meta).encode('utf-8'))
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        """
+        Deletes least recently used entries until the cache is 10% below its size cap. Must hold the lock.
+        """
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.name.endswith(".gz")),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            size = entry.stat().st_size
+            for path in (entry.path, entry.path[:-len(".gz")] + ".json"):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.total_bytes -= size
+
+def write_atomically(path: str, data: bytes) -> None:
+    """
+    Writes a file through a temporary name, so a kill mid-write never leaves a partial file behind.
+
+    :param path: The destination path.
+    :param data: The bytes to write.
+    """
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as temp_file:
+        temp_file.write(data)
+    os.replace(temp_path, path)
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+def fetch_once(key: str, fetch: Callable[[], Any]) -> Any:
+    """
+    Runs fetch, unless another thread is already running it for the same key, in which case its result is shared.
+
+    :param key: What is being fetched, usually a URL.
+    :param fetch: A function performing the fetch.
+    :return: The result of fetch.
+    """
+    with in_flight_lock:
+        future = in_flight.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = in_flight[key] = Future()
+    if not is_owner:
+        return future.result()
+
+    try:
+        result = fetch()
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with in_flight_lock:
+            del in_flight[key]
+
+def get_response_cache() -> ResponseCache:
+    """
+    Returns the shared response cache, opening it on first use.
+    """
+    global response_cache
+    with response_cache_lock:
+        if response_cache is None:
+            response_cache = ResponseCache(cache_dir, cache_max_bytes)
+        return response_cache
+
 def setup_filesystem(workspace: str, tsv_path: str) -> None:
     """
     Sets up the necessary filesystem for operation by ensuring that the workspace and TSV paths exist.
@@ -345,6 +1495,9 @@ def setup_filesystem(workspace: str, tsv_path: str) -> None:
             # The file is created and closed immediately as it's opened in write mode.
             pass
 
+    # Drop a half-written final row left behind by a killed run
+    repair_truncated_line(tsv_path)
+
 
 def process_string(original_string: str) -> str:
     """
@@ -390,11 +1543,26 @@ def update_pages_count(html: str, current_pages_count: Optional[int] = 999999) -
 
 
 
-def get_html(url: AnyStr) -> AnyStr:
+def revalidation_headers(meta: dict) -> dict:
     """
-    Fetches the HTML content from a given URL.
+    Builds the conditional request headers which ask the server to answer 304 if a cached copy is still current.
+
+    :param meta: The cached metadata, as returned by ResponseCache.load.
+    :return: The If-None-Match and If-Modified-Since headers for the validators the entry has.
+    """
+    request_headers = {}
+    if meta.get("etag"):
+        request_headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        request_headers["If-Modified-Since"] = meta["last_modified"]
+    return request_headers
+
+def get_html(url: AnyStr, ttl: int = sentence_cache_ttl) -> AnyStr:
+    """
+    Fetches the HTML content from a given URL, going through the response cache.
 
     :param url: The URL from which to fetch the HTML content.
+    :param ttl: How many seconds a cached copy may be used before it is revalidated with the server.
     :return: A string containing the decoded HTML content.
     :raises HTTPError: An error from the server if the response code is not 200.
     :raises URLError: A failure to reach the server.
@@ -403,12 +1571,24 @@ def get_html(url: AnyStr) -> AnyStr:
     # Example usage:
     # print(get_html("http://example.com"))
 
+    response_cache = get_response_cache()
+    cached = response_cache.load(url)
+    if cached is not None and time.time() - cached[0]["fetched"] < ttl:
+        return cached[1].decode('utf-8')
+
+    # Ask the server whether our stale copy is still good
+    request_headers = revalidation_headers(cached[0]) if cached is not None else {}
+
     try:
-        with urllib.request.urlopen(url) as response:
-            if response.getcode() != 200:
-                raise HTTPError(url, response.getcode(), "Error response for search", response.headers, None)
-            html_content = response.read().decode('utf-8')
-            return html_content
+        status, headers, body = http_pool.get(url, request_headers)
+        if status == 304 and cached is not None:
+            response_cache.store(url, headers, None, cached[0])
+            return cached[1].decode('utf-8')
+        if status != 200:
+            raise HTTPError(url, status, "Error response for search", headers, None)
+        html_content = body.decode('utf-8')
+        response_cache.store(url, headers, body)
+        return html_content
     except HTTPError as e:
         print(f'HTTP error occurred: {e.code} - {e.reason}')
         raise
@@ -419,26 +1599,125 @@ def get_html(url: AnyStr) -> AnyStr:
 
 
 
-def append_to_file(num: str, sentence: str, translation_list: list, tsv_path: str) -> None:
+def load_manifest(manifest_path: str) -> dict:
+    """
+    Loads the crawl manifest, or returns a fresh one if none has been saved yet.
+
+    The manifest records the real pages count, the last page such that it and every page before it are done,
+    and a per-page status which is either "done" or "partial".
+
+    :param manifest_path: The path to the manifest JSON file.
+    :return: The manifest as a dictionary.
+    """
+    manifest = {"pages_count": 999999, "last_completed_page": 0, "pages": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as manifest_file:
+            manifest.update(json.load(manifest_file))
+    return manifest
+
+def save_manifest(manifest: dict, manifest_path: str) -> None:
+    """
+    Atomically writes the crawl manifest, so that a kill mid-write never leaves a corrupt file behind.
+
+    :param manifest: The manifest as a dictionary.
+    :param manifest_path: The path to the manifest JSON file.
+    """
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(temp_path, manifest_path)
+
+def first_incomplete_page(manifest: dict) -> int:
+    """
+    Finds the first page which has not been fully processed.
+
+    :param manifest: The manifest as a dictionary.
+    :return: The page number to resume from.
+    """
+    page_number = manifest["last_completed_page"] + 1
+    while manifest["pages"].get(str(page_number)) == "done":
+        page_number += 1
+    return page_number
+
+def load_sentence_ids(tsv_path: str) -> Set[str]:
+    """
+    Builds an index of the sentence IDs already present in a TSV file.
+    The ID is the last field of every line written by append_to_file.
+
+    :param tsv_path: The path to the TSV file.
+    :return: A set of sentence IDs as strings.
+    """
+    sentence_ids = set()
+    with open(tsv_path, 'r', encoding='utf-8') as tsv_file:
+        for line in tsv_file:
+            line = line.rstrip("\n")
+            if line:
+                sentence_ids.add(line.rsplit(separator, 1)[-1])
+    return sentence_ids
+
+def translation_priority_key() -> str:
+    """
+    Returns a short fingerprint of translation_priority, which tells apart the settings a sentence was skipped under.
+    """
+    return hashlib.sha256(json.dumps(translation_priority).encode('utf-8')).hexdigest()[:16]
+
+def load_skipped_ids(skipped_path: str) -> Set[str]:
+    """
+    Reads the IDs of the sentences recorded by record_skipped which still apply: those that are gone,
+    and those without a wanted translation under the current translation_priority.
+
+    :param skipped_path: The path to the skipped IDs file, with an ID and a reason on each line.
+    :return: A set of sentence IDs as strings, empty if nothing has been skipped yet.
+    """
+    if not os.path.exists(skipped_path):
+        return set()
+    reasons = ("gone", translation_priority_key())
+    sentence_ids = set()
+    with open(skipped_path, 'r', encoding='utf-8') as skipped_file:
+        for line in skipped_file:
+            num_str, _, reason = line.rstrip("\n").partition(separator)
+            if reason in reasons:
+                sentence_ids.add(num_str)
+    return sentence_ids
+
+def record_skipped(deck: "Deck", num_str: str, sentence_ids: Set[str], reason: str) -> None:
+    """
+    Remembers that a sentence was skipped, so later runs count it as done without fetching it.
+
+    :param deck: The deck the sentence belongs to.
+    :param num_str: The sentence number as a string.
+    :param sentence_ids: The set of processed sentence IDs, which the ID is added to.
+    :param reason: "gone" if the sentence or its audio no longer exists,
+                   or the translation_priority_key the sentence had no wanted translation under.
+    """
+    with open(deck.skipped_path, 'a', encoding='utf-8') as skipped_file:
+        skipped_file.write(f"{num_str}{separator}{reason}\n")
+    sentence_ids.add(num_str)
+
+def append_to_file(num: str, sentence: str, translation_list: list, tsv_file: TsvWriter, sentence_ids: Optional[Set[str]] = None) -> None:
     """
     Appends a line to a TSV file with a specific format.
 
     :param num: The identifier number, which is also used for the mp3 filename.
     :param sentence: The sentence to be recorded in the file.
     :param translation_list: A list of translations to be appended after the sentence.
-    :param tsv_path: The path to the TSV file.
+    :param tsv_file: The TsvWriter for the TSV file.
+    :param sentence_ids: An optional index from load_sentence_ids, updated with the new ID once it is written.
     """
 
     # Example usage
-    # append_to_file('001', 'Hello, world!', ['Hola, mundo!', 'Bonjour, monde!'], 'translations.tsv')
+    # with TsvWriter('translations.tsv') as tsv_file:
+    #     append_to_file('001', 'Hello, world!', ['Hola, mundo!', 'Bonjour, monde!'], tsv_file)
 
     # Constructing the line to write to the TSV file
     line_elements = [f'[sound:{num}.mp3]'] + [sentence] + translation_list + [num]
     line = separator.join(line_elements) + "\n"
 
     # Writing the constructed line to the TSV file
-    with open(tsv_path, "a") as tsv_file:
-        tsv_file.write(line)
+    tsv_file.write(line)
+
+    if sentence_ids is not None:
+        sentence_ids.add(num)
 
 
 
@@ -450,18 +1729,51 @@ def append_to_file(num: str, sentence: str, translation_list: list, tsv_path: st
 
 
 
-def setup():
-    global target_lang, workspace, tsv_path
-    target_lang = sys.argv[1]
-    workspace = os.path.join("generated_files", target_lang)
-    tsv_path = os.path.join(workspace, "import.tsv")
+class Deck:
+    """
+    One target language being built, with its own workspace, import file and crawl manifest.
+    """
+
+    def __init__(self, target_lang: str) -> None:
+        self.target_lang = target_lang
+        self.workspace = os.path.join("generated_files", target_lang)
+        self.tsv_path = os.path.join(self.workspace, "import.tsv")
+        self.manifest_path = os.path.join(self.workspace, "manifest.json")
+        self.skipped_path = os.path.join(self.workspace, "skipped.txt")
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Scrape sentences with audio from tatoeba into Anki import files.")
+    parser.add_argument("target_langs", nargs="+", metavar="target_lang",
+                        help="The language codes of the sentences to scrape, e.g. jpn. Each language gets its own deck.")
+    parser.add_argument("--from-exports", metavar="DIR",
+                        help="Build the decks from extracted tatoeba CSV exports in DIR instead of scraping sentence pages.")
+    parser.add_argument("--sync", action="store_true",
+                        help="Top up existing decks with the newest recordings, stopping once sentences are already known.")
+    parser.add_argument("--backend", choices=["api", "html"], default=sentence_backend_name,
+                        help="Look sentences up through the JSON API (falling back to pages) or only through the rendered pages.")
+    parser.add_argument("--postprocess", action="store_true",
+                        help="Loudness-normalise the audio of the decks with ffmpeg and point their import files at the results.")
+    parser.add_argument("--codec", choices=["mp3", "opus"], default="mp3",
+                        help="The codec of post-processed audio. Opus is much smaller at the same quality.")
+    parser.add_argument("--bitrate", default="64k",
+                        help="The bitrate of post-processed audio, e.g. 32k for Opus.")
+    parser.add_argument("--verify-audio", action="store_true",
+                        help="Check the audio of every sentence already in the decks and download again any that is missing or corrupt.")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    # Check if at least one command line argument is provided
-    print(sys.argv)
-    if len(sys.argv) > 1:
-        setup()
-        main()
+    args = parse_args()
+    decks = [Deck(target_lang) for target_lang in dict.fromkeys(args.target_langs)]
+    sentence_backend = make_sentence_backend(args.backend)
+    if args.verify_audio:
+        for deck in decks:
+            verify_audio(deck)
+    elif args.postprocess:
+        for deck in decks:
+            postprocess_audio(deck, args.codec, args.bitrate)
+    elif args.from_exports:
+        for deck in decks:
+            ingest_exports(deck, args.from_exports)
     else:
-        print("No language code provided.")
+        main(decks, args.sync)
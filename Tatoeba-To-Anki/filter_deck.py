@@ -0,0 +1,289 @@
+import os, re, mmap, argparse, subprocess
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, List, Tuple
+
+
+# A streaming filter for deck TSVs, as written by Tatoeba-To-Anki.py:
+#     [sound:123.mp3] <tab> sentence <tab> translation... <tab> 123
+#
+# Per-row predicates (length, token count, audio duration, presence of a translation) are independent of every
+# other row, so large files are cut into newline-aligned chunks of an mmap and checked in a process pool.
+# Duplicate removal depends on which rows came first, so it runs afterwards, over the chunks in file order.
+# The output is therefore byte-for-byte the same as with --workers 1.
+
+# Files smaller than this are not worth splitting across processes
+min_chunk_bytes = 4 * 1024 * 1024
+
+sound_pattern = re.compile(r'\[sound:([^\]]+)\]')
+
+
+class Filters:
+    """
+    The per-row predicates to apply. A value of None disables that predicate.
+    """
+
+    def __init__(self, audio_dir: str, min_length: Optional[int] = None, max_length: Optional[int] = None,
+                 min_tokens: Optional[int] = None, max_tokens: Optional[int] = None,
+                 min_duration: Optional[float] = None, max_duration: Optional[float] = None,
+                 require_translation: bool = False) -> None:
+        self.audio_dir = audio_dir
+        self.min_length = min_length
+        self.max_length = max_length
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.require_translation = require_translation
+
+    def keep(self, fields: List[str]) -> bool:
+        """
+        Decides whether a row passes every predicate.
+
+        :param fields: The fields of the row.
+        :return: True if the row should be kept.
+        """
+        if len(fields) < 2:
+            return False
+        sentence = fields[1]
+
+        if self.min_length is not None and len(sentence) < self.min_length:
+            return False
+        if self.max_length is not None and len(sentence) > self.max_length:
+            return False
+
+        if self.min_tokens is not None or self.max_tokens is not None:
+            tokens = len(sentence.split())
+            if self.min_tokens is not None and tokens < self.min_tokens:
+                return False
+            if self.max_tokens is not None and tokens > self.max_tokens:
+                return False
+
+        if self.require_translation and not any(field.strip() for field in fields[2:-1]):
+            return False
+
+        if self.min_duration is not None or self.max_duration is not None:
+            sound_match = sound_pattern.search(fields[0])
+            duration = audio_duration(os.path.join(self.audio_dir, sound_match.group(1))) if sound_match else None
+            # Rows whose duration cannot be measured are kept rather than silently lost
+            if duration is not None:
+                if self.min_duration is not None and duration < self.min_duration:
+                    return False
+                if self.max_duration is not None and duration > self.max_duration:
+                    return False
+
+        return True
+
+
+# Bitrates in kbps and sample rates in Hz, indexed by the MPEG version bits of a frame header
+mp3_bitrates = {
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],  # MPEG-1 layer III
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],      # MPEG-2 layer III
+    0: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],      # MPEG-2.5 layer III
+}
+mp3_sample_rates = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+def audio_duration(path: str) -> Optional[float]:
+    """
+    Measures the duration of an audio file in seconds.
+    mp3s are measured from their headers, using the Xing/Info frame count if there is one.
+    Anything else is handed to ffprobe.
+
+    :param path: The path to the audio file.
+    :return: The duration, or None if it could not be measured.
+    """
+    if path.lower().endswith(".mp3"):
+        duration = mp3_duration(path)
+        if duration is not None:
+            return duration
+    try:
+        output = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+                                check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+        return float(output.strip())
+    except (subprocess.CalledProcessError, OSError, ValueError):
+        return None
+
+def mp3_duration(path: str) -> Optional[float]:
+    """
+    Estimates the duration of an mp3 from its first frame header.
+
+    :param path: The path to the mp3.
+    :return: The duration in seconds, or None if the file does not look like a layer III mp3.
+    """
+    try:
+        with open(path, 'rb') as audio_file:
+            data = audio_file.read(16384)
+            file_size = os.fstat(audio_file.fileno()).st_size
+    except OSError:
+        return None
+
+    # Skip an ID3v2 tag, whose size is stored as four 7-bit bytes.
+    # base is the position in the file of data[0].
+    base = 0
+    offset = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        offset = 10 + ((data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F))
+        if offset + 4 > len(data):
+            with open(path, 'rb') as audio_file:
+                audio_file.seek(offset)
+                data = audio_file.read(16384)
+            base, offset = offset, 0
+
+    # Find the first frame sync
+    while offset + 4 <= len(data) and not (data[offset] == 0xFF and data[offset + 1] & 0xE0 == 0xE0):
+        offset += 1
+    if offset + 4 > len(data):
+        return None
+    version = (data[offset + 1] >> 3) & 0x03
+    layer = (data[offset + 1] >> 1) & 0x03
+    bitrate_index = data[offset + 2] >> 4
+    sample_rate_index = (data[offset + 2] >> 2) & 0x03
+    channel_mode = data[offset + 3] >> 6
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    sample_rate = mp3_sample_rates[version][sample_rate_index]
+    samples_per_frame = 1152 if version == 3 else 576
+
+    # A Xing or Info header in the first frame holds the exact frame count, which VBR files need
+    side_info = (32 if channel_mode != 3 else 17) if version == 3 else (17 if channel_mode != 3 else 9)
+    xing = offset + 4 + side_info
+    if data[xing:xing + 4] in (b"Xing", b"Info") and len(data) >= xing + 12 and data[xing + 7] & 0x01:
+        frames = int.from_bytes(data[xing + 8:xing + 12], "big")
+        return frames * samples_per_frame / sample_rate
+
+    # Otherwise assume a constant bitrate
+    bitrate = mp3_bitrates[version][bitrate_index] * 1000
+    return (file_size - base - offset) * 8 / bitrate
+
+
+def chunk_bounds(data: mmap.mmap, chunks: int) -> List[Tuple[int, int]]:
+    """
+    Cuts a file into roughly equal byte ranges which each end right after a newline.
+
+    :param data: The mapped file.
+    :param chunks: How many chunks to aim for.
+    :return: A list of (start, end) byte offsets.
+    """
+    size = len(data)
+    bounds = []
+    start = 0
+    for i in range(1, chunks + 1):
+        if start >= size:
+            break
+        end = size if i == chunks else max(start, size * i // chunks)
+        if end < size:
+            newline = data.find(b"\n", end)
+            end = size if newline == -1 else newline + 1
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+def filter_chunk(path: str, start: int, end: int, filters: Filters) -> Tuple[int, List[Tuple[str, str]]]:
+    """
+    Applies the per-row predicates to one chunk of a file. Runs in a worker process.
+
+    :param path: The path to the TSV file.
+    :param start: The byte offset of the first row of the chunk.
+    :param end: The byte offset right after the last row of the chunk.
+    :param filters: The predicates to apply.
+    :return: A tuple of the number of rows in the chunk and the kept rows, each as a tuple of the raw line and its sentence.
+    """
+    kept = []
+    with open(path, 'rb') as tsv_file, mmap.mmap(tsv_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        lines = data[start:end].decode('utf-8').split("\n")
+    # A chunk ends right after a newline, except possibly the last one
+    if lines[-1] == "":
+        lines.pop()
+        lines = [line + "\n" for line in lines]
+    else:
+        lines = [line + "\n" for line in lines[:-1]] + [lines[-1]]
+    for line in lines:
+        fields = line.rstrip("\n").split("\t")
+        if filters.keep(fields):
+            kept.append((line, fields[1]))
+    return len(lines), kept
+
+def near_duplicate_key(sentence: str) -> str:
+    """
+    Reduces a sentence to its letters and digits, so that differences in case, spacing and punctuation are ignored.
+    """
+    return "".join(character for character in sentence.casefold() if character.isalnum())
+
+def filter_deck(input_file: str, output_file: str, filters: Filters, dedup: bool, near_dedup: bool, workers: int) -> Tuple[int, int]:
+    """
+    Filters a deck TSV into a new file.
+
+    :param input_file: The path to the TSV to read.
+    :param output_file: The path to the TSV to write.
+    :param filters: The per-row predicates.
+    :param dedup: Drop rows whose sentence is exactly the same as an earlier row's.
+    :param near_dedup: Drop rows whose sentence only differs from an earlier row's in case, spacing or punctuation.
+    :param workers: How many processes to use.
+    :return: A tuple of the number of rows read and written.
+    """
+    size = os.path.getsize(input_file)
+    if size == 0:
+        open(output_file, 'w').close()
+        return 0, 0
+
+    with open(input_file, 'rb') as tsv_file, mmap.mmap(tsv_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        bounds = chunk_bounds(data, max(1, min(workers * 4, size // min_chunk_bytes)))
+
+    if workers > 1 and len(bounds) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunk_results = executor.map(filter_chunk, [input_file] * len(bounds), [start for start, _ in bounds],
+                                         [end for _, end in bounds], [filters] * len(bounds))
+            return write_rows(output_file, chunk_results, dedup, near_dedup)
+    chunk_results = (filter_chunk(input_file, start, end, filters) for start, end in bounds)
+    return write_rows(output_file, chunk_results, dedup, near_dedup)
+
+def write_rows(output_file: str, chunk_results, dedup: bool, near_dedup: bool) -> Tuple[int, int]:
+    """
+    Writes the kept rows of every chunk in file order, dropping duplicates of earlier rows.
+
+    :return: A tuple of the number of rows read and written.
+    """
+    seen = set()
+    rows_read = 0
+    rows_written = 0
+    with open(output_file, 'w', encoding='utf-8') as outfile:
+        for chunk_rows, kept in chunk_results:
+            rows_read += chunk_rows
+            for line, sentence in kept:
+                if dedup or near_dedup:
+                    key = near_duplicate_key(sentence) if near_dedup else sentence
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                outfile.write(line)
+                rows_written += 1
+    return rows_read, rows_written
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Filter and deduplicate a deck TSV generated by Tatoeba-To-Anki.")
+    parser.add_argument("lang_code", help="The deck to filter, read from generated_files/<lang_code>/import.tsv.")
+    parser.add_argument("--input", help="Read this TSV instead of the deck's import.tsv.")
+    parser.add_argument("--output", help="Write to this TSV instead of the deck's filtered.tsv.")
+    parser.add_argument("--min-length", type=int, help="Drop sentences with fewer characters than this.")
+    parser.add_argument("--max-length", type=int, help="Drop sentences with more characters than this.")
+    parser.add_argument("--min-tokens", type=int, help="Drop sentences with fewer whitespace-separated words than this.")
+    parser.add_argument("--max-tokens", type=int, help="Drop sentences with more whitespace-separated words than this.")
+    parser.add_argument("--min-duration", type=float, help="Drop sentences whose audio is shorter than this many seconds.")
+    parser.add_argument("--max-duration", type=float, help="Drop sentences whose audio is longer than this many seconds.")
+    parser.add_argument("--require-translation", action="store_true", help="Drop sentences with no translation at all.")
+    parser.add_argument("--dedup", action="store_true", help="Drop sentences identical to an earlier one.")
+    parser.add_argument("--near-dedup", action="store_true",
+                        help="Drop sentences that only differ from an earlier one in case, spacing or punctuation.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="How many processes to filter with.")
+    args = parser.parse_args(argv)
+    workspace = os.path.join("generated_files", args.lang_code)
+    args.input = args.input or os.path.join(workspace, "import.tsv")
+    args.output = args.output or os.path.join(workspace, "filtered.tsv")
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    filters = Filters(os.path.dirname(os.path.abspath(args.input)), args.min_length, args.max_length,
+                      args.min_tokens, args.max_tokens, args.min_duration, args.max_duration, args.require_translation)
+    rows_read, rows_written = filter_deck(args.input, args.output, filters, args.dedup, args.near_dedup, args.workers)
+    print(f"Kept {rows_written} of {rows_read} rows in {args.output}")
@@ -1,13 +1,9 @@
 import os, sys
+from filter_deck import Filters, filter_deck
 
 def filter_tsv(input_file, output_file, max_length):
-    with open(input_file, 'r', encoding='utf-8') as infile, open(output_file, 'w', encoding='utf-8') as outfile:
-        for line in infile:
-            fields = line.split('\t')
-            sentence = fields[1]
-
-            if len(sentence) <= max_length:
-                outfile.write(line)
+    filters = Filters(os.path.dirname(os.path.abspath(input_file)), max_length=max_length)
+    filter_deck(input_file, output_file, filters, dedup=False, near_dedup=False, workers=1)
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
@@ -18,4 +14,3 @@ if __name__ == "__main__":
         max_length = int(sys.argv[2])  # Convert the command line argument to an integer
 
         filter_tsv(input_file, output_file, max_length)
-
@@ -5,23 +5,60 @@ import time
 import subprocess
 import shutil
 import json
-import re
-import readline
 import glob
+import re
+import sys
+import argparse
+import threading
+import tempfile
+import hashlib
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
-from tkinter import Tk
-from tkinter.filedialog import askopenfilename, asksaveasfilename, askdirectory
+
+# tsv_writer.py lives at the root of the repository, one level up, and is shared with the other script.
+# Keep the directory layout when copying this script elsewhere, or put a copy of tsv_writer.py next to it.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from tsv_writer import TsvWriter, repair_truncated_line
+from subtitles import parse_subtitles, write_srt, format_srt_time
 
 keyFile = open(os.path.expanduser("~/openaikey"), 'r')
 apikey = keyFile.readline().rstrip()
 keyFile.close()
-client = OpenAI(api_key=apikey)
-gpt_batch_size = 5
-
-def make_project_folder():
-    project_name = input("Select a project name. This will be appended to all of the generated media files to group them: ")
+# Set OPENAI_BASE_URL to talk to any OpenAI-compatible server instead, e.g. a local stub for testing
+client = OpenAI(api_key=apikey, base_url=os.environ.get("OPENAI_BASE_URL") or None)
+gpt_model = "gpt-5-nano"
+# Lines are packed into a request until its estimated size reaches gpt_batch_tokens, and never more than gpt_batch_size lines
+gpt_batch_size = 20
+gpt_batch_tokens = 400
+# How many batches may be waiting on gpt at the same time, and how many times each batch is tried
+gpt_max_in_flight = 4
+gpt_attempts = 2
+# Word maps from earlier runs are kept here and reused across projects, so repeated lines are only paid for once.
+# Entries are dropped least recently used first once there are more than wordmap_cache_max_entries.
+wordmap_cache_path = os.path.expanduser("~/.cache/ankimmerse/wordmaps.json")
+wordmap_cache_max_entries = 100000
+# How many clips or frames to cut per ffmpeg process. Each process reads its source once, seeking to its first entry.
+media_batch_size = 100
+# How many ffmpeg processes may cut media at the same time
+media_workers = os.cpu_count() or 2
+# Audio clips are cut straight from the video's audio stream and encoded with clip_codec at clip_bitrate.
+# Set keep_full_audio to also write the whole track to audio.mp3 first, as older projects did; clips then come from it.
+clip_codecs = {"mp3": ("libmp3lame", "mp3"), "opus": ("libopus", "opus"), "aac": ("aac", "m4a")}
+clip_codec = "mp3"
+clip_bitrate = "128k"
+keep_full_audio = False
+# Card images less than this many seconds apart (the end of one line and the start of the next) are taken once and shared
+frame_reuse_tolerance = 0.3
+# Card images whose 64-bit perceptual hashes differ in at most this many bits are stored once. None turns this off.
+image_dedup_max_distance = 4
+
+def make_project_folder(project_name=None, parent_directory=None):
+    if project_name is None:
+        project_name = input("Select a project name. This will be appended to all of the generated media files to group them: ")
     media_prefix = project_name
-    output_folder_path = os.path.join(os.getcwd(), media_prefix)
+    output_folder_path = os.path.join(parent_directory or os.getcwd(), media_prefix)
     if os.path.exists(output_folder_path):
         print("Seems this project already exists! Continuing where we left off...")
     else:
@@ -32,6 +69,9 @@ def make_project_folder():
     return output_folder_path, media_prefix
 
 def request_path_check_valid(prompt, initialdir):
+    # tkinter is only needed by the interactive mode, so batch mode runs on servers without it
+    from tkinter import Tk
+    from tkinter.filedialog import askopenfilename
     # Initialize the Tkinter root
     root = Tk()
     # Hide the root window
@@ -70,6 +110,8 @@ def get_video(output_folder_path):
     output_path = None
     if choice == 'y':
         youtube_link = input("Enter the YouTube video link: ").strip()
+        from tkinter import Tk
+        from tkinter.filedialog import askdirectory
         # Initialize the Tkinter root
         root = Tk()
         # Hide the root window
@@ -95,61 +137,81 @@ def get_video(output_folder_path):
         file.write(video_path)
     return video_path
 
-def clean_subs(srt_path):
-    with open(srt_path, 'r', encoding='utf-8') as f:
-        srt_lines = f.readlines()
-
-    # Regular expression patterns to match HTML tags and comments
-    html_pattern = re.compile(r'<.*?>')
-    comment_pattern = re.compile(r'{.*?}')
-
-    # Remove HTML tags and comments from each line in the subtitles
-    cleaned_lines = []
-    for line in srt_lines:
-        line = html_pattern.sub('', line)  # Remove HTML tags
-        line = comment_pattern.sub('', line)  # Remove comments
-        cleaned_lines.append(line)
-
-    # Write the cleaned subtitles back to the SRT file
-    with open(srt_path, 'w', encoding='utf-8') as f:
-        f.writelines(cleaned_lines)
-
-def convert_to_srt_time(seconds):
-    ms = int((seconds % 1) * 1000)
-    seconds = int(seconds)
-    minutes = seconds // 60
-    seconds %= 60
-    hours = minutes // 60
-    minutes %= 60
-    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{ms:03d}"
-
-def generate_srt_with_sound_references(subs_file, stream_index, video_file, media_prefix, output_folder_path):
-    ffprobe_output = subprocess.check_output(["ffprobe", "-v", "error", "-select_streams", stream_index, "-show_entries", "packet=pts_time,duration_time", "-of", "csv=p=0", video_file], stderr=subprocess.PIPE, text=True)
-
-    timestamps = ffprobe_output.strip().split('\n')
-    timestamps = [line.split(",") for line in timestamps]
-
-    audio_files = [f"{media_prefix}_{i+1}_translation.mp3" for i in range(len(timestamps))]
-
-    print_audio_streams(video_file)
-    audio_stream = input("Since you chose a bitmap based subtitle, please enter the audio stream index number for a language you understand: ") #TODO check the number is valid
-
-    with open(subs_file, 'w') as subs:
-        for i, (begin_time, duration) in enumerate(timestamps):
-            begin_time_float = float(begin_time)
-            end_time_float = begin_time_float + float(duration)
-            begin_time_srt = convert_to_srt_time(begin_time_float)
-            end_time_srt = convert_to_srt_time(end_time_float)
-            audio_path = os.path.join(output_folder_path, "media", audio_files[i])
-            subs.write(f"{i + 1}\n{begin_time_srt} --> {end_time_srt}\n{audio_files[i]}\n\n")
-            if not os.path.exists(audio_path):
-                cmd = ["ffmpeg", "-nostdin", "-i", video_file, "-map", f"0:{audio_stream}", "-ss", begin_time_srt.replace(",", "."), "-to", end_time_srt.replace(",", "."), audio_path]
-                subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+# Bitmap subtitle lines become cards whose text is the name of a clip of the translation audio, like "ep1_12_translation.mp3"
+translation_clip_pattern = re.compile(r"[^/\\]+_\d+_translation\.\w+")
+
+def generate_srt_with_sound_references(subs_file, stream_index, video_file, media_prefix, output_folder_path, audio_stream=None):
+    if audio_stream is None:
+        print_audio_streams(video_file)
+        audio_stream = input("Since you chose a bitmap based subtitle, please enter the audio stream index number for a language you understand: ") #TODO check the number is valid
+
+    # Remember the stream, so a later run can cut the clips this one could not
+    with open(os.path.join(output_folder_path, "translation_audio_stream.txt"), "w") as audio_stream_file:
+        audio_stream_file.write(str(audio_stream))
+
+    # ffprobe's packet list is read line by line as it comes out, writing the subtitle file
+    clip_count = 0
+    ffprobe_cmd = ["ffprobe", "-v", "error", "-select_streams", stream_index, "-show_entries", "packet=pts_time,duration_time", "-of", "csv=p=0", video_file]
+    # stderr goes to a file rather than a pipe, so a chatty ffprobe can't block while only stdout is being read
+    ffprobe_errors = tempfile.TemporaryFile(mode="w+")
+    ffprobe = subprocess.Popen(ffprobe_cmd, stdout=subprocess.PIPE, stderr=ffprobe_errors, text=True)
+    with ffprobe_errors, ffprobe, open(subs_file, 'w') as subs:
+        for line in ffprobe.stdout:
+            try:
+                begin_time, duration = line.strip().split(",")[:2]
+                begin_ms = round(float(begin_time) * 1000)
+                end_ms = begin_ms + round(float(duration) * 1000)
+            except ValueError:
+                print(f"Skipping subtitle packet without a usable time: {line.strip()}")
+                continue
+            clip_count += 1
+            audio_file = f"{media_prefix}_{clip_count}_translation.{clip_codecs[clip_codec][1]}"
+            subs.write(f"{clip_count}\n{format_srt_time(begin_ms)} --> {format_srt_time(end_ms)}\n{audio_file}\n\n")
+        ffprobe.wait()
+        ffprobe_errors.seek(0)
+        ffprobe_stderr = ffprobe_errors.read()
+    if ffprobe.returncode != 0:
+        # Leave no subtitle file behind, or the next run would skip this step
+        os.remove(subs_file)
+        raise subprocess.CalledProcessError(ffprobe.returncode, ffprobe_cmd, stderr=ffprobe_stderr)
+
+    return cut_translation_clips(video_file, output_folder_path, audio_stream)
+
+def cut_translation_clips(video_file, output_folder_path, audio_stream):
+    # Bitmap subtitle lines are written to subs.srt as the names of clips of the translation audio, cut here.
+    # Clips already on disk are skipped, so a later run only cuts the ones that failed or that were never reached.
+    # All clips are cut with input seeking, in a few ffmpeg runs that each decode the audio stream once over their
+    # stretch of the episode, instead of one run per packet decoding from the start of the file
+    clip_jobs = []
+    for _, begin_ms, end_ms, text in parse_subtitles(os.path.join(output_folder_path, "subs.srt")):
+        audio_path = os.path.join(output_folder_path, "media", text)
+        if translation_clip_pattern.fullmatch(text) and not media_done(audio_path):
+            clip_jobs.append((begin_ms / 1000, (end_ms - begin_ms) / 1000, [audio_path]))
+    print(f"Cutting {len(clip_jobs)} translation audio clips...")
+    batches = split_ffmpeg_batches(video_file, clip_jobs, clip_output_args(audio_stream, clip_encoding_args(video_file)))
+    with ThreadPoolExecutor(max_workers=media_workers) as media_executor:
+        return wait_for_media([media_executor.submit(run_ffmpeg_batch, *batch) for batch in batches])
+
+def recut_translation_clips(video_file, output_folder_path):
+    # For a project whose subs.srt is already there: cuts any translation clip an earlier run did not finish
+    audio_stream = load_translation_audio_stream(output_folder_path)
+    if audio_stream is None:
+        return []
+    return cut_translation_clips(video_file, output_folder_path, audio_stream)
+
+def load_translation_audio_stream(output_folder_path):
+    # Only projects made from bitmap subtitles have one
+    try:
+        with open(os.path.join(output_folder_path, "translation_audio_stream.txt"), "r") as audio_stream_file:
+            return audio_stream_file.readline().strip()
+    except FileNotFoundError:
+        return None
 
 def get_subtitles(video_file, output_folder_path, media_prefix):
     subs = os.path.join(output_folder_path, "subs.srt")
     if os.path.exists(subs):
         print("Subtitle file already exists. Skipping step.")
+        recut_translation_clips(video_file, output_folder_path)
         return
 
     use_subs_file = None
@@ -184,11 +246,8 @@ def get_subtitles(video_file, output_folder_path, media_prefix):
                 print("Option not recognized! Try again.")
 
     if use_subs_file:
-        # Search for subtitle files in the same directory as the video file
         video_dir = os.path.dirname(video_file)
-        video_filename_without_ext = os.path.splitext(os.path.basename(video_file))[0]
-        subtitle_files = glob.glob(os.path.join(video_dir, video_filename_without_ext + ".*.vtt"))
-        subtitle_files.extend(glob.glob(os.path.join(video_dir, video_filename_without_ext + ".*.srt")))
+        subtitle_files = find_subtitle_files(video_file)
 
         chosen_file = None
         if subtitle_files:
@@ -210,8 +269,7 @@ def get_subtitles(video_file, output_folder_path, media_prefix):
             print(f"No subtitle files with a matching name in the same folder as the video were found.")
         if chosen_file == None:
             chosen_file = request_path_check_valid("Select an external subs file", video_dir)
-        # Copy the provided subtitle file to the subs file for Anki
-        subprocess.run(["ffmpeg", "-i", chosen_file, subs], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        extract_subtitles(video_file, output_folder_path, media_prefix, subs_source=chosen_file)
     else:
         chosen_sub = None
         while chosen_sub == None:
@@ -225,16 +283,7 @@ def get_subtitles(video_file, output_folder_path, media_prefix):
             if chosen_sub == None:
                 print("Index not recognized. Try again!")
 
-        if chosen_sub.get("codec_name") == "dvd_subtitle":
-            print("Generating SRT file with sound references for bitmap subtitles...")
-            generate_srt_with_sound_references(subs, subs_stream, video_file, media_prefix, output_folder_path)
-        else:
-            print("Extracting and converting subtitles from video. This should not take more than 2 minutes.")
-            # Extract the subtitle stream from the video file and save it to the subtitle file in SRT format
-            subprocess.run(["ffmpeg", "-i", video_file, "-map", f"0:{subs_stream}", subs], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-
-    print("Removing HTML and other inline markup including <> and {} blocks from subtitles...")
-    clean_subs(subs)
+        extract_subtitles(video_file, output_folder_path, media_prefix, subs_stream=subs_stream, bitmap=chosen_sub.get("codec_name") == "dvd_subtitle")
 
     # Prompt user
     user_response = input(f"\nYou have the option to remove extraneous subtitles by editing the subtitle file.\nDo you want to open it with vim for editing? (Y/n): ")
@@ -248,6 +297,42 @@ def get_subtitles(video_file, output_folder_path, media_prefix):
     else:
         print("Proceeding with unedited subtitles.")
 
+def find_subtitle_files(video_file):
+    # Subtitle files named like the video, e.g. "episode.ja.srt" next to "episode.mkv"
+    video_dir = os.path.dirname(video_file)
+    video_filename_without_ext = glob.escape(os.path.splitext(os.path.basename(video_file))[0])
+    subtitle_files = []
+    for extension in ["vtt", "srt", "ass"]:
+        subtitle_files.extend(glob.glob(os.path.join(video_dir, video_filename_without_ext + ".*." + extension)))
+    return subtitle_files
+
+def extract_subtitles(video_file, output_folder_path, media_prefix, subs_source=None, subs_stream=None, bitmap=False, translation_audio_stream=None):
+    # Writes subs.srt from an external subtitle file, or else from the video's subtitle stream subs_stream.
+    # Returns the translation clips of bitmap subtitles that could not be cut, as wait_for_media does.
+    subs = os.path.join(output_folder_path, "subs.srt")
+    clip_failures = []
+    if subs_source is None:
+        if bitmap:
+            print("Generating SRT file with sound references for bitmap subtitles...")
+            clip_failures = generate_srt_with_sound_references(subs, subs_stream, video_file, media_prefix, output_folder_path, translation_audio_stream)
+        else:
+            print("Extracting and converting subtitles from video. This should not take more than 2 minutes.")
+            # Extract the subtitle stream from the video file and save it to the subtitle file in SRT format
+            try:
+                subprocess.run(["ffmpeg", "-nostdin", "-i", video_file, "-map", f"0:{subs_stream}", subs], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+            except subprocess.CalledProcessError as e:
+                print("Error occurred while running ffmpeg for subtitle extraction:")
+                print(e.stderr)
+                if os.path.exists(subs):
+                    os.remove(subs)
+                raise
+        subs_source = subs
+
+    # SRT, WebVTT and ASS files are read directly and written back out as the SRT for Anki
+    print("Removing HTML and other inline markup including <> and {} blocks from subtitles...")
+    write_srt(parse_subtitles(subs_source), subs)
+    return clip_failures
+
 def print_audio_streams(video_file):
     ffprobe_audio_output = subprocess.check_output(["ffprobe", video_file, "-select_streams", "a", "-show_streams", "-of", "json"], stderr=subprocess.PIPE, text=True)
     audio_data = json.loads(ffprobe_audio_output)
@@ -262,114 +347,407 @@ def print_audio_streams(video_file):
         print(f"Index: {index}, Codec Name: {codec_name}, Language: {language}")
     return count
 
-def get_audio(video_file, output_folder_path):
+def get_audio(video_file, output_folder_path, audio_stream=None):
     audio_file = os.path.join(output_folder_path, "audio.mp3")
     if os.path.exists(audio_file):
         print("Audio file already exists. Skipping step.")
         return
+    if audio_stream is None:
+        audio_stream = load_audio_stream(output_folder_path)
+        if audio_stream is not None and not keep_full_audio:
+            print("Audio stream already chosen. Skipping step.")
+            return
 
     try:
-        count = print_audio_streams(video_file)
-        audio_stream = 1 if count==1 else input("Enter the audio stream index number: ") #TODO check the number is valid
+        if audio_stream is None:
+            count = print_audio_streams(video_file)
+            audio_stream = 1 if count==1 else input("Enter the audio stream index number: ") #TODO check the number is valid
+        # Remember the stream, make_deck cuts the clips from it
+        with open(os.path.join(output_folder_path, "audio_stream.txt"), "w") as audio_stream_file:
+            audio_stream_file.write(str(audio_stream))
+        if not keep_full_audio:
+            return
         print("Extracting and converting audio from video. This will take a few minutes.")
 
         # Extract the audio stream using ffmpeg and save it to the audio file
-        subprocess.run(["ffmpeg", "-i", video_file, "-map", f"0:{audio_stream}", audio_file], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        subprocess.run(["ffmpeg", "-nostdin", "-i", video_file, "-map", f"0:{audio_stream}", audio_file], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
 
     except subprocess.CalledProcessError as e:
         print("Error occurred while running ffprobe/ffmpeg for audio extraction:")
         print(e.stderr)
+        # A partial audio.mp3 would be taken for a finished one; without it the clips are cut from the video instead
+        if os.path.exists(audio_file):
+            os.remove(audio_file)
 
-def parse_subtitle_entry(subs_file, buffer):
-
+def load_audio_stream(output_folder_path):
     try:
-        entry_lines = []
-
-        # Get the initial file position
-        initial_pos = subs_file.tell()
-
-        # Read the lines until an empty line is encountered, indicating the end of the entry
-        while True:
-            line = subs_file.readline().strip()
-
-            # Empty line indicates the end of the entry
-            if not line:
-                # Check if the current position is the same as the initial position
-                # If it is, then we have reached the end of the file
-                current_pos = subs_file.tell()
-                if current_pos == initial_pos:
-                    return "EOF"  # End of file, no more entries
-                break  # Empty line within the entry, end of the entry
-
-            entry_lines.append(line)
-
-        # Check if the entry has at least three lines (index, timestamps, and dialogue)
-        if len(entry_lines) >= 3:
-            # Parse the index
-            index = entry_lines[0]
-
-            # Parse the timestamps (begin_time and end_time)
-            begin_time_str, end_time_str = re.findall(r'\d+:\d+:\d+,\d+', entry_lines[1])
-            begin_time_str = begin_time_str.replace(",", ":")
-            end_time_str = end_time_str.replace(",", ":")
-
-            # Convert the timestamps to seconds
-            begin_time_seconds = sum(x * int(t) for x, t in zip([3600, 60, 1, 1/1000], begin_time_str.split(":")[0:4]))
-            end_time_seconds = sum(x * int(t) for x, t in zip([3600, 60, 1, 1/1000], end_time_str.split(":")[0:4]))
-
-            begin_time_seconds -= buffer
-            end_time_seconds += buffer
-
-            # Convert the adjusted times back to their original format
-            begin_time_adjusted = '{:02d}:{:02d}:{:02d}.{}'.format(int(begin_time_seconds // 3600), int((begin_time_seconds % 3600) // 60), int(begin_time_seconds % 60), int((begin_time_seconds % 1) * 1000))
-            end_time_adjusted = '{:02d}:{:02d}:{:02d}.{}'.format(int(end_time_seconds // 3600), int((end_time_seconds % 3600) // 60), int(end_time_seconds % 60), int((end_time_seconds % 1) * 1000))
-
-            # Concatenate the dialogue lines into a single string
-            dialogue = ' '.join(entry_lines[2:]).replace("\"", "")
+        with open(os.path.join(output_folder_path, "audio_stream.txt"), "r") as audio_stream_file:
+            return audio_stream_file.readline().strip()
+    except FileNotFoundError:
+        return None
 
-            return (index, begin_time_adjusted, end_time_adjusted, dialogue)
+def clip_encoding_args(source):
+    # Clips from an mp3 into mp3 are copied without re-encoding, anything else is encoded per clip
+    if clip_codec == "mp3" and source.lower().endswith(".mp3"):
+        return ["-acodec", "copy"]
+    return ["-c:a", clip_codecs[clip_codec][0], "-b:a", clip_bitrate]
+
+def media_names(media_prefix, index):
+    return f"{media_prefix}_{index}.{clip_codecs[clip_codec][1]}", f"{media_prefix}_{index}-begin.jpg", f"{media_prefix}_{index}-end.jpg"
+
+def split_ffmpeg_batches(source, jobs, output_args):
+    # jobs is a list of (seconds, extra, output_paths), sorted here by time.
+    # Each ffmpeg run seeks its input once, to the first job of the batch, then every output picks its own
+    # start relative to that point, so the source is opened and decoded once per batch instead of once per file.
+    # output_args(seek, batch, paths) gives the ffmpeg arguments after the input, writing each job to its paths.
+    # Batches are kept small enough that every media worker gets some.
+    jobs = sorted(jobs, key=lambda job: job[0])
+    batch_size = max(1, min(media_batch_size, -(-len(jobs) // media_workers)))
+    return [(source, jobs[start:start + batch_size], output_args) for start in range(0, len(jobs), batch_size)]
+
+def partial_path(path):
+    # ffmpeg writes here, and the file only gets its real name once the whole run has succeeded
+    root, extension = os.path.splitext(path)
+    return root + ".part" + extension
+
+def media_done(path):
+    # Files under their real name are complete; an empty one can only be left over from an older, interrupted run
+    return os.path.exists(path) and os.path.getsize(path) > 0
+
+def run_ffmpeg_batch(source, batch, output_args):
+    seek = batch[0][0]
+    partial_paths = [[partial_path(path) for path in output_paths] for _, _, output_paths in batch]
+    cmd = ["ffmpeg", "-nostdin", "-y", "-v", "error", "-ss", f"{seek:.3f}", "-i", source] + output_args(seek, batch, partial_paths)
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        error = (result.stderr.strip() or f"ffmpeg exited with code {result.returncode}") if result.returncode != 0 else ""
+    except OSError as e:
+        error = str(e)
+
+    # ffmpeg opens every output when it starts, so after an error any of them may be cut short: all are thrown away.
+    # Otherwise each job's files are renamed into place, the main file last, and the rest are reported.
+    failures = []
+    for (_, _, output_paths), job_partial_paths in zip(batch, partial_paths):
+        if not error and all(media_done(path) for path in job_partial_paths):
+            for path, final_path in reversed(list(zip(job_partial_paths, output_paths))):
+                os.replace(path, final_path)
+            continue
+        for path in job_partial_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        failures.append((output_paths[0], error.splitlines()[-1] if error else "no output written"))
+    return len(batch), failures
+
+def clip_output_args(stream, encoding_args):
+    # Audio clips: every output trims its own stretch of the decoded stream
+    def output_args(seek, batch, paths):
+        args = []
+        for (seconds, duration, _), (path,) in zip(batch, paths):
+            args += ["-map", f"0:{stream}", "-ss", f"{seconds - seek:.3f}", "-t", f"{duration:.3f}"] + encoding_args + [path]
+        return args
+    return output_args
+
+def frame_output_args(seek, batch, paths):
+    # Images: the decoded video is split into a branch per image, each branch drops frames until its time and keeps
+    # the next one, and only that frame is scaled, for the image and for the 9x8 grayscale copy dedup_images hashes.
+    # Dropping a frame in trim costs nothing, unlike output -ss, which scales every frame before throwing it away.
+    image_scale_filter = "scale='min(1280,iw)':'min(720,ih)'"
+    graph = [f"[0:v:0]split={len(batch)}" + "".join(f"[s{i}]" for i in range(len(batch)))]
+    args = []
+    for i, ((seconds, _, _), (image_path, hash_path)) in enumerate(zip(batch, paths)):
+        graph.append(f"[s{i}]trim=start={seconds - seek:.3f},trim=end_frame=1,{image_scale_filter},split[i{i}][g{i}]")
+        graph.append(f"[g{i}]scale=9:8:flags=area,format=gray[h{i}]")
+        args += ["-map", f"[i{i}]", "-frames:v", "1", "-q:v", "2", image_path,
+                 "-map", f"[h{i}]", "-frames:v", "1", "-f", "rawvideo", hash_path]
+    return ["-filter_complex", ";".join(graph)] + args
+
+def start_media_extraction(executor, video_file, clip_source, clip_stream, media_directory, subtitles, media_prefix, image_aliases):
+    hash_directory = os.path.join(os.path.dirname(media_directory), "frame_hashes")
+    os.makedirs(hash_directory, exist_ok=True)
+
+    clip_jobs = []
+    frames = []
+    for index, begin_ms, end_ms, dialogue in subtitles:
+        audio_name, image_begin_name, image_end_name = media_names(media_prefix, index)
+        begin_seconds = begin_ms / 1000
+        end_seconds = end_ms / 1000
+        # Entries whose files were finished are left alone, so an interrupted run picks up where it stopped
+        if not media_done(os.path.join(media_directory, audio_name)):
+            clip_jobs.append((begin_seconds, end_seconds - begin_seconds, [os.path.join(media_directory, audio_name)]))
+        for seconds, name in [(begin_seconds, image_begin_name), (end_seconds, image_end_name)]:
+            if name not in image_aliases and not media_done(os.path.join(media_directory, name)):
+                frames.append((seconds, name))
+
+    # A frame within frame_reuse_tolerance of the one before it is not cut again; its cards use the earlier image
+    frame_jobs = []
+    frames.sort()
+    for seconds, name in frames:
+        if frame_jobs and seconds - frame_jobs[-1][0] <= frame_reuse_tolerance:
+            add_image_alias(image_aliases, name, os.path.basename(frame_jobs[-1][2][0]))
+            continue
+        frame_jobs.append((seconds, None, [os.path.join(media_directory, name), os.path.join(hash_directory, name + ".gray")]))
+
+    batches = split_ffmpeg_batches(clip_source, clip_jobs, clip_output_args(clip_stream, clip_encoding_args(clip_source)))
+    batches += split_ffmpeg_batches(video_file, frame_jobs, frame_output_args)
+
+    total = len(clip_jobs) + len(frame_jobs)
+    print(f"Cutting {len(clip_jobs)} audio clips and {len(frame_jobs)} images in the background...")
+    progress = {"done": 0}
+    progress_lock = threading.Lock()
+
+    def report_progress(future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        with progress_lock:
+            progress["done"] += future.result()[0]
+            print(f"Media: {progress['done']}/{total} files processed.")
+
+    futures = []
+    for batch in batches:
+        future = executor.submit(run_ffmpeg_batch, *batch)
+        future.add_done_callback(report_progress)
+        futures.append(future)
+    return futures
+
+def wait_for_media(futures):
+    failures = []
+    for future in futures:
+        failures += future.result()[1]
+    if failures:
+        print(f"\n{len(failures)} media files could not be cut. Run again to retry them:")
+        for output_path, error in failures:
+            print(f"  {os.path.basename(output_path)}: {error}")
+    return failures
+
+def load_image_aliases(output_folder_path):
+    # Image name -> the name of the shared image its cards use instead, from frame reuse and dedup_images
+    try:
+        with open(os.path.join(output_folder_path, "image_aliases.json"), "r") as aliases_file:
+            return json.load(aliases_file)
+    except FileNotFoundError:
+        return {}
+
+def save_image_aliases(output_folder_path, image_aliases):
+    aliases_path = os.path.join(output_folder_path, "image_aliases.json")
+    with open(aliases_path + ".tmp", "w") as aliases_file:
+        json.dump(image_aliases, aliases_file, indent=1)
+    os.replace(aliases_path + ".tmp", aliases_path)
+
+def add_image_alias(image_aliases, name, shared_name):
+    # Anything already pointing at name now points at shared_name too, so aliases never chain
+    for alias, target in image_aliases.items():
+        if target == name:
+            image_aliases[alias] = shared_name
+    image_aliases[name] = shared_name
+
+def perceptual_hash(hash_path):
+    # A 64-bit difference hash: one bit per pair of neighbouring pixels in each row of the 9x8 grayscale frame
+    try:
+        with open(hash_path, "rb") as hash_file:
+            pixels = hash_file.read()
+    except FileNotFoundError:
+        return None
+    if len(pixels) != 72:
+        return None
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return bits
+
+def dedup_images(output_folder_path, import_path, image_aliases):
+    # Stores near-identical card images once: every image close enough to an earlier one is deleted, aliased to it,
+    # and its references in import.tsv are rewritten
+    media_directory = os.path.join(output_folder_path, "media")
+    hash_directory = os.path.join(output_folder_path, "frame_hashes")
+    if image_dedup_max_distance is None or not os.path.isdir(hash_directory):
+        return 0
+
+    kept = []
+    duplicates = {}
+    for hash_name in sorted(os.listdir(hash_directory)):
+        name = hash_name[:-len(".gray")]
+        if name in image_aliases or not os.path.exists(os.path.join(media_directory, name)):
+            continue
+        image_hash = perceptual_hash(os.path.join(hash_directory, hash_name))
+        if image_hash is None:
+            continue
+        for kept_name, kept_hash in kept:
+            if bin(image_hash ^ kept_hash).count("1") <= image_dedup_max_distance:
+                duplicates[name] = kept_name
+                break
         else:
-            print(entry_lines)
-            return "skip"
-    except Exception as e:
-        raise ValueError(f"Error occurred while parsing SRT entry: {str(e)}")
-
-
-wordmap_queue = []
-def get_wordmap(dialogue):
-    global wordmap_queue
-    if len(wordmap_queue) == 0:
-        response = client.responses.parse(
-            model="gpt-5-nano",
-            input=[
-                {
-                    "role": "system",
-                    "content": "You will be provided with sentences. Translate them each to English, and make a 'word map', each one on a separate line. As an example:\n\n" +
-                    "1\t俺も俺のために 君を手伝う\n" +
-                    "2\tMakanya efeknya juga bakal berdampak panjang\n\n" +
-                    "Sample answer:\n\n" +
-                    '1\tI will also help you for my sake\t{"俺も":"I", "俺の":"my", "ために":"sake", "君を":"you", "手伝う":"help"}\n' +
-                    '2\tSo the effect will also have a long-term impact\t{"Makanya":"So", "efeknya":"the effect", "juga":"also", "bakal":"will", "berdampak":"impact", "panjang":"long-term"}\n\n' +
-                    "The translation and the wordmap should be separated by a tab, with all line numbers preserved. All entries in the wordmap (both key and value) should be substrings of the sentence or translation as-written. There should be no multi-word keys in the wordmap." 
-                },
-                {
-                    "role": "user",
-                    "content": "\n".join(dialogue)
-                }
-            ],
-        ).output_text
-        wordmap_queue_add = response.strip().split("\n")
-        if len(wordmap_queue_add) != len(dialogue):
-            raise ValueError(f"Asked gpt for {len(dialogue)} entries but got {len(wordmap_queue_add)} back!")
-        for i in range(len(dialogue)):
-            if not wordmap_queue_add[i].startswith(str(i+1) + "\t"):
-                raise ValueError(f"gpt response misnumbered!")
-            if len(wordmap_queue_add[i].split("\t")) != 3:
-                raise ValueError(f"gpt response tabs misformatted!")
-        wordmap_queue += wordmap_queue_add
-    return wordmap_queue.pop(0)
-
-def make_deck(video_file, output_folder_path, media_prefix):
+            kept.append((name, image_hash))
+    if not duplicates:
+        return 0
+
+    for name, shared_name in duplicates.items():
+        add_image_alias(image_aliases, name, shared_name)
+    save_image_aliases(output_folder_path, image_aliases)
+    if os.path.exists(import_path):
+        with open(import_path, "r", encoding="utf-8") as import_file:
+            rows = import_file.read()
+        rows = re.sub(r"<img src='([^']*)'>", lambda match: f"<img src='{image_aliases.get(match.group(1), match.group(1))}'>", rows)
+        with open(import_path + ".tmp", "w", encoding="utf-8") as import_file:
+            import_file.write(rows)
+        os.replace(import_path + ".tmp", import_path)
+    for name in duplicates:
+        os.remove(os.path.join(media_directory, name))
+    print(f"Removed {len(duplicates)} near-duplicate images.")
+    return len(duplicates)
+
+wordmap_system_prompt = (
+    "You will be provided with sentences. Translate them each to English, and make a 'word map', each one on a separate line. As an example:\n\n" +
+    "1\t俺も俺のために 君を手伝う\n" +
+    "2\tMakanya efeknya juga bakal berdampak panjang\n\n" +
+    "Sample answer:\n\n" +
+    '1\tI will also help you for my sake\t{"俺も":"I", "俺の":"my", "ために":"sake", "君を":"you", "手伝う":"help"}\n' +
+    '2\tSo the effect will also have a long-term impact\t{"Makanya":"So", "efeknya":"the effect", "juga":"also", "bakal":"will", "berdampak":"impact", "panjang":"long-term"}\n\n' +
+    "The translation and the wordmap should be separated by a tab, with all line numbers preserved. All entries in the wordmap (both key and value) should be substrings of the sentence or translation as-written. There should be no multi-word keys in the wordmap."
+)
+
+def get_wordmaps(dialogues):
+    # Returns a (translation, wordmap) pair for each dialogue line, in the same order, or None for lines gpt never answered.
+    # Answers are matched to lines by their number, so a missing or garbled answer only costs that line,
+    # and the next attempt asks again for just the lines that are still missing.
+    wordmaps = [None] * len(dialogues)
+    for attempt in range(1, gpt_attempts + 1):
+        missing = [i for i, wordmap in enumerate(wordmaps) if wordmap is None]
+        numbered = [f"{i+1}\t{dialogues[i]}" for i in missing]
+        try:
+            response = client.responses.parse(
+                model=gpt_model,
+                input=[
+                    {"role": "system", "content": wordmap_system_prompt},
+                    {"role": "user", "content": "\n".join(numbered)},
+                ],
+            ).output_text
+            for response_line in response.strip().split("\n"):
+                fields = response_line.strip().split("\t")
+                if len(fields) != 3 or not fields[0].isdigit():
+                    continue
+                i = int(fields[0]) - 1
+                if i in missing:
+                    wordmaps[i] = (fields[1], fields[2])
+            still_missing = sum(1 for wordmap in wordmaps if wordmap is None)
+            if not still_missing:
+                return wordmaps
+            error = f"{still_missing} of {len(missing)} lines missing or misformatted in the gpt response"
+        except Exception as e:
+            error = e
+        if attempt < gpt_attempts:
+            wait_time = 2 ** attempt
+            print(f"Attempt {attempt} failed with error: {error}. Retrying in {wait_time:.2f} seconds...")
+            time.sleep(wait_time)
+    print(f"Giving up on {[dialogues[i] for i, wordmap in enumerate(wordmaps) if wordmap is None]}: {error}\n")
+    return wordmaps
+
+def normalise_dialogue(dialogue):
+    # Lines that only differ in unicode width or spacing get the same translation
+    return " ".join(unicodedata.normalize("NFKC", dialogue).split())
+
+def estimate_tokens(text):
+    # A rough count without a tokenizer: about one token per CJK character and per four other characters
+    wide = sum(1 for character in text if ord(character) >= 0x2e80)
+    return wide + (len(text) - wide) // 4 + 1
+
+def pack_wordmap_batches(dialogues):
+    # Splits the lines into requests of at most gpt_batch_tokens estimated tokens (answers are a few times longer
+    # than the question, so the budget is counted on the question) and gpt_batch_size lines
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for dialogue in dialogues:
+        tokens = estimate_tokens(dialogue)
+        if batch and (batch_tokens + tokens > gpt_batch_tokens or len(batch) >= gpt_batch_size):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(dialogue)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+class WordmapCache:
+    # A persistent (translation, wordmap) store keyed by dialogue, model and system prompt, with LRU eviction
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # A new model or prompt gives new keys, so stale answers are never served; they just age out
+        self.key_prefix = gpt_model + "\0" + hashlib.sha256(wordmap_system_prompt.encode("utf-8")).hexdigest() + "\0"
+        self.entries = OrderedDict()
+        try:
+            with open(path, "r", encoding="utf-8") as cache_file:
+                # Saved oldest first, so the load order is the LRU order
+                for key, value in json.load(cache_file):
+                    self.entries[key] = tuple(value)
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError) as e:
+            print(f"Ignoring unreadable word map cache {path}: {e}")
+
+    def key(self, dialogue):
+        return hashlib.sha256((self.key_prefix + normalise_dialogue(dialogue)).encode("utf-8")).hexdigest()
+
+    def get(self, dialogue):
+        key = self.key(dialogue)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, dialogue, wordmap):
+        key = self.key(dialogue)
+        with self.lock:
+            self.entries[key] = tuple(wordmap)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # Write to a temporary file first so a crash never leaves a half-written cache.
+        # The lock is held throughout so two episodes finishing together don't write the temporary file at once.
+        with self.lock:
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w", encoding="utf-8") as cache_file:
+                json.dump(list(self.entries.items()), cache_file, ensure_ascii=False)
+            os.replace(temporary_path, self.path)
+
+wordmap_cache = None
+wordmap_cache_lock = threading.Lock()
+
+def get_wordmap_cache():
+    # One cache for the whole process, so episodes made in parallel share answers and never overwrite each other's saves
+    global wordmap_cache
+    with wordmap_cache_lock:
+        if wordmap_cache is None:
+            wordmap_cache = WordmapCache(wordmap_cache_path, wordmap_cache_max_entries)
+        return wordmap_cache
+
+def get_cached_wordmaps(dialogues, cache):
+    # Like get_wordmaps, but every answer is also stored in the cache
+    wordmaps = get_wordmaps(dialogues)
+    for dialogue, wordmap in zip(dialogues, wordmaps):
+        if wordmap is not None:
+            cache.put(dialogue, wordmap)
+    return wordmaps
+
+def load_deck_index(import_path):
+    # The set of dialogue lines that already have a card, read from the first column of the import file
+    deck_index = set()
+    try:
+        with open(import_path, "r", encoding="utf-8") as import_file:
+            for line in import_file:
+                deck_index.add(line.split("\t", 1)[0].rstrip("\n"))
+    except FileNotFoundError:
+        pass
+    return deck_index
+
+def make_deck(video_file, output_folder_path, media_prefix, buffer=None):
     print("\nCreating cards!")
 
     # Read the subtitles and cut up the video
@@ -378,7 +756,7 @@ def make_deck(video_file, output_folder_path, media_prefix):
     full_audio_path = os.path.join(output_folder_path, "audio.mp3")
 
 
-    while True:
+    while buffer is None:
         buffer_input = input("Enter a value for buffer (default is 0.5): ")
 
         try:
@@ -392,88 +770,111 @@ def make_deck(video_file, output_folder_path, media_prefix):
         except ValueError:
             print("Error: Please enter a valid numeric value for buffer.")
 
-    try:
-        with open(import_path, "r") as import_read_file:
-            import_read = import_read_file.read()
-    except FileNotFoundError:
-        import_read = ""
+    # Drop a half-written final row left behind by a killed run
+    repair_truncated_line(import_path)
+    deck_index = load_deck_index(import_path)
 
-    srt_data_list = []
-    with open(subs_path, "r") as subs_file:
-        while True:
-            srt_data = parse_subtitle_entry(subs_file, buffer)
-            if srt_data == "EOF":
-                break
-            if srt_data == "skip":
-                continue
-            srt_data_list.append(srt_data)
-
-    with open(import_path, "a+") as import_file_handle:
-        for i in range(len(srt_data_list)):
-            srt_data = srt_data_list[i]
-            index, begin_time, end_time, dialogue = srt_data
-
-            media_directory = os.path.join(output_folder_path, "media")
-            audio_name = f"{media_prefix}_{index}.mp3"
-            audio_path = os.path.join(media_directory, audio_name)
-
-            # Generate audio snippet
-            if not os.path.exists(audio_path):
-                subprocess.run(["ffmpeg", "-nostdin", "-i", full_audio_path, "-acodec", "copy", "-ss", begin_time, "-to", end_time, audio_path], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-
-            # Bound image size to 1280x720
-            image_scale_filter = "scale='min(1280,iw)':'min(720,ih)'"
-            image_begin_name = f"{media_prefix}_{index}-begin.jpg"
-            image_begin_path = os.path.join(media_directory, image_begin_name)
-            image_end_name = f"{media_prefix}_{index}-end.jpg"
-            image_end_path = os.path.join(media_directory, image_end_name)
-
-            # Generate images
-            if not os.path.exists(image_begin_path):
-                subprocess.run(["ffmpeg", "-nostdin", "-ss", begin_time, "-i", video_file, "-vf", image_scale_filter, "-vframes", "1", "-q:v", "2", image_begin_path], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-            if not os.path.exists(image_end_path):
-                subprocess.run(["ffmpeg", "-nostdin", "-ss", end_time, "-i", video_file, "-vf", image_scale_filter, "-vframes", "1", "-q:v", "2", image_end_path], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-
-            if dialogue in import_read:
+    subtitles = parse_subtitles(subs_path).with_buffer(round(buffer * 1000))
+
+    # Cut every audio clip and image in a pool of ffmpeg workers, a few processes per episode rather than three
+    # per line. This runs in the background while the cards are written.
+    media_directory = os.path.join(output_folder_path, "media")
+    media_executor = ThreadPoolExecutor(max_workers=media_workers)
+    image_aliases = load_image_aliases(output_folder_path)
+    # Clips come from audio.mp3 if the project has one, otherwise straight from the chosen audio stream of the video
+    if os.path.exists(full_audio_path):
+        clip_source, clip_stream = full_audio_path, "a:0"
+    else:
+        clip_source, clip_stream = video_file, load_audio_stream(output_folder_path) or "a:0"
+    media_futures = start_media_extraction(media_executor, video_file, clip_source, clip_stream, media_directory, subtitles, media_prefix, image_aliases)
+    save_image_aliases(output_folder_path, image_aliases)
+
+    # Rows are flushed once per gpt batch, so a crash loses at most one batch of answers
+    with media_executor, TsvWriter(import_path, flush_rows=gpt_batch_size, flush_seconds=30.0) as import_file_handle:
+        # Lines already in the deck are left out. Of the rest, each distinct line is looked up in the cache
+        # and the ones that miss are packed into batches for gpt, several in flight at a time.
+        pending = []
+        for index, begin_ms, end_ms, dialogue in subtitles:
+            if dialogue in deck_index:
                 print(f"Dialogue {dialogue} already in file, skipping!")
                 continue
-
-            dialogue_arr = []
-            for delta in range(gpt_batch_size):
-                if i+delta >= len(srt_data_list):
-                    break
-                upcoming_srt_data = srt_data_list[i+delta]
-                _,_,_,upcoming_dialogue = upcoming_srt_data
-                dialogue_arr.append(str(delta+1) + "\t" + upcoming_dialogue)
-            print(str(dialogue_arr) + "\n")
-            attempt = 0
-            while attempt < 2:
-                try:
-                    response = get_wordmap(dialogue_arr)
-                    print(str(response) + "\n")
-                    line_number, native_text, wordmap = response.split('\t')
-                    # Write the line as an Anki card
-                    text_line = f"{dialogue}\t{native_text}\t{wordmap}\t{audio_name}\t<img src='{image_begin_name}'>\t<img src='{image_end_name}'>\n"
-                    print(str(text_line.rstrip()) + "\n")
-                    import_file_handle.write(text_line)
-                    break
-                except Exception as e:
-                    attempt += 1
-                    wait_time = (2 ** attempt) # Exponential backoff with jitter
-                    print(f"Attempt {attempt} failed with error: {e}. Retrying in {wait_time:.2f} seconds...")
-                    time.sleep(wait_time)
+            pending.append((index, dialogue))
+
+        wordmap_cache = get_wordmap_cache()
+        # Normalised line -> its cached answer, or else the batch that will answer it and its position in that batch
+        cached = {}
+        scheduled = {}
+        to_translate = []
+        for index, dialogue in pending:
+            key = normalise_dialogue(dialogue)
+            if key in cached or key in scheduled:
+                continue
+            cached[key] = wordmap_cache.get(dialogue)
+            if cached[key] is None:
+                del cached[key]
+                scheduled[key] = None
+                to_translate.append(dialogue)
+        batches = pack_wordmap_batches(to_translate)
+        print(f"{len(pending)} new lines, {len(cached) + len(scheduled)} distinct, {len(to_translate)} to translate in {len(batches)} requests.")
+
+        with ThreadPoolExecutor(max_workers=gpt_max_in_flight) as gpt_executor:
+            for batch in batches:
+                wordmap_future = gpt_executor.submit(get_cached_wordmaps, batch, wordmap_cache)
+                for position, dialogue in enumerate(batch):
+                    scheduled[normalise_dialogue(dialogue)] = (wordmap_future, position)
+
+            # Batches are packed in subtitle order, so waiting on each line's batch in turn writes the cards in order
+            cards_written = 0
+            untranslated = 0
+            for index, dialogue in pending:
+                # A line repeated within the episode only gets a card the first time
+                if dialogue in deck_index:
+                    continue
+                key = normalise_dialogue(dialogue)
+                if key in cached:
+                    answer = cached[key]
+                else:
+                    wordmap_future, position = scheduled[key]
+                    try:
+                        answer = wordmap_future.result()[position]
+                    except Exception as e:
+                        print(f"Giving up on {dialogue}: {e}\n")
+                        untranslated += 1
+                        continue
+                    if answer is None:
+                        untranslated += 1
+                        continue
+                native_text, wordmap = answer
+                audio_name, image_begin_name, image_end_name = media_names(media_prefix, index)
+                image_begin_name = image_aliases.get(image_begin_name, image_begin_name)
+                image_end_name = image_aliases.get(image_end_name, image_end_name)
+                # Write the line as an Anki card
+                text_line = f"{dialogue}\t{native_text}\t{wordmap}\t{audio_name}\t<img src='{image_begin_name}'>\t<img src='{image_end_name}'>\n"
+                print(str(text_line.rstrip()) + "\n")
+                import_file_handle.write(text_line)
+                deck_index.add(dialogue)
+                cards_written += 1
+        wordmap_cache.save()
+        print(f"Word map cache: {len(cached)} hits, {len(scheduled)} misses.")
+        media_failures = wait_for_media(media_futures)
+    dedup_images(output_folder_path, import_path, image_aliases)
     print("Done making deck!\n")
+    return {"cards": cards_written, "untranslated": untranslated, "cache_hits": len(cached), "cache_misses": len(scheduled), "media_failures": len(media_failures)}
 
 
-def move_files_to_anki_media(output_folder_path):
-    answer = input("Do you want to copy all files from anki/data/ to ~/anki_media/? (y/n): ").lower()
-    if answer == "y":
+def move_files_to_anki_media(output_folder_path, copy=None):
+    if copy is None:
+        copy = input("Do you want to copy all files from anki/data/ to ~/anki_media/? (y/n): ").lower() == "y"
+    if copy:
         media_directory = os.path.join(output_folder_path, "media")
         destination_dir = os.path.expanduser("~/anki_media/")
         print("Copying files...")
         if not os.path.exists(destination_dir):
             os.makedirs(destination_dir)
         for file_name in os.listdir(media_directory):
+            # Unfinished files of an interrupted ffmpeg run are not media
+            if ".part." in file_name:
+                continue
             source_file_path = os.path.join(media_directory, file_name)
             destination_file_path = os.path.join(destination_dir, file_name)
             shutil.copy(source_file_path, destination_file_path)
@@ -481,8 +882,167 @@ def move_files_to_anki_media(output_folder_path):
     else:
         print("Skipping file copy.")
 
+# Settings for the headless batch mode, overridden by a --config JSON file and then by command line flags.
+# prefix names each project and its media files; {name} is the video's file name.
+batch_defaults = {
+    "inputs": [],
+    "output_dir": None,
+    "prefix": "{name}",
+    "buffer": 0.5,
+    "audio_stream": "a:0",
+    "subtitle_stream": None,
+    "subtitle_language": None,
+    "translation_audio_stream": None,
+    "clip_codec": "mp3",
+    "clip_bitrate": "128k",
+    "keep_full_audio": False,
+    "jobs": 2,
+    "copy_media": False,
+}
+video_extensions = (".mkv", ".mp4", ".webm", ".avi", ".mov", ".m4v")
+
+def find_videos(inputs):
+    # Expands video files, directories (every video directly inside) and glob patterns, in order and without repeats
+    videos = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            paths = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern)) if name.lower().endswith(video_extensions)]
+        else:
+            paths = sorted(glob.glob(pattern))
+        if not paths:
+            print(f"Nothing found for {pattern}.")
+        for path in paths:
+            path = os.path.abspath(path)
+            if path not in videos:
+                videos.append(path)
+    return videos
+
+def probe_streams(video_file, stream_type):
+    ffprobe_output = subprocess.check_output(["ffprobe", "-v", "error", video_file, "-select_streams", stream_type, "-show_streams", "-of", "json"], stderr=subprocess.PIPE, text=True)
+    return json.loads(ffprobe_output).get("streams", [])
+
+def choose_subtitles(video_file, settings):
+    # Picks an episode's subtitles without asking: the subtitle_stream index if one is set, else a subtitle file named
+    # like the video, else the first text subtitle stream. subtitle_language narrows the last two, e.g. "ja".
+    language = settings["subtitle_language"]
+    if settings["subtitle_stream"] is not None:
+        for stream in probe_streams(video_file, "s"):
+            if str(stream.get("index")) == str(settings["subtitle_stream"]):
+                bitmap = stream.get("codec_name") == "dvd_subtitle"
+                if bitmap and settings["translation_audio_stream"] is None:
+                    raise ValueError(f"Subtitle stream {stream.get('index')} is bitmap-based and needs a translation_audio_stream")
+                return {"subs_stream": str(stream.get("index")), "bitmap": bitmap, "translation_audio_stream": settings["translation_audio_stream"]}
+        raise ValueError(f"No subtitle stream with index {settings['subtitle_stream']}")
+
+    for subtitle_file in sorted(find_subtitle_files(video_file)):
+        # "episode.ja.srt" is in language "ja"
+        if language is None or subtitle_file.split(".")[-2] == language:
+            return {"subs_source": subtitle_file}
+    for stream in probe_streams(video_file, "s"):
+        if stream.get("codec_name") != "dvd_subtitle" and language in (None, stream.get("tags", {}).get("language")):
+            return {"subs_stream": str(stream.get("index"))}
+    raise ValueError("No text subtitles found" + (f" in language {language}" if language else ""))
+
+def process_episode(video_file, settings):
+    started = time.monotonic()
+    name = os.path.splitext(os.path.basename(video_file))[0]
+    safe_name = "".join(character if character.isalnum() or character in "-_" else "_" for character in name)
+    output_folder_path, media_prefix = make_project_folder(settings["prefix"].format(name=safe_name), settings["output_dir"])
+    # Remember the video like get_video does, so the project can be picked up again interactively
+    with open(os.path.join(output_folder_path, "video_path.txt"), "w") as video_path_file:
+        video_path_file.write(video_file)
+
+    if os.path.exists(os.path.join(output_folder_path, "subs.srt")):
+        print("Subtitle file already exists. Skipping step.")
+        clip_failures = recut_translation_clips(video_file, output_folder_path)
+    else:
+        clip_failures = extract_subtitles(video_file, output_folder_path, media_prefix, **choose_subtitles(video_file, settings))
+    get_audio(video_file, output_folder_path, settings["audio_stream"])
+    stats = make_deck(video_file, output_folder_path, media_prefix, settings["buffer"])
+    stats["media_failures"] += len(clip_failures)
+    if settings["copy_media"]:
+        move_files_to_anki_media(output_folder_path, copy=True)
+    stats["seconds"] = time.monotonic() - started
+    return stats
+
+def run_batch(settings):
+    # Makes a deck for every video without any prompts, a few episodes at a time, then prints how each one went
+    global clip_codec, clip_bitrate, keep_full_audio
+    clip_codec, clip_bitrate, keep_full_audio = settings["clip_codec"], settings["clip_bitrate"], settings["keep_full_audio"]
+    videos = find_videos(settings["inputs"])
+    if not videos:
+        print("No videos to process.")
+        return 1
+    print(f"Processing {len(videos)} episodes, {settings['jobs']} at a time...")
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=settings["jobs"]) as episode_executor:
+        episode_futures = {video: episode_executor.submit(process_episode, video, settings) for video in videos}
+        for video, episode_future in episode_futures.items():
+            try:
+                results[video] = episode_future.result()
+            except Exception as e:
+                results[video] = e
+
+    print("\nSummary:")
+    failed = 0
+    totals = {"cards": 0, "untranslated": 0, "cache_hits": 0, "cache_misses": 0, "media_failures": 0}
+    for video in videos:
+        result = results[video]
+        if isinstance(result, Exception):
+            failed += 1
+            # ffmpeg and ffprobe failures carry their own explanation on stderr
+            details = result.stderr.strip().splitlines()[-1:] if isinstance(result, subprocess.CalledProcessError) and result.stderr else []
+            print(f"  FAILED  {os.path.basename(video)}: {' '.join([str(result)] + details)}")
+            continue
+        for key in totals:
+            totals[key] += result[key]
+        print(f"  OK      {os.path.basename(video)}: {result['cards']} cards, {result['untranslated']} untranslated lines, "
+              f"{result['media_failures']} missing media files, {result['cache_hits']} cache hits, {result['seconds']:.0f}s")
+    print(f"{len(videos) - failed} of {len(videos)} episodes done: {totals['cards']} cards, {totals['untranslated']} untranslated lines, "
+          f"{totals['media_failures']} missing media files, {totals['cache_hits']} cache hits, {totals['cache_misses']} lines sent to gpt.")
+    return 1 if failed else 0
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Makes Anki cards from videos. Run without arguments for the interactive mode, "
+                                                 "or give videos, directories or globs to process them all without prompts.")
+    parser.add_argument("inputs", nargs="*", help="Video files, directories of videos or glob patterns")
+    parser.add_argument("--config", help="A JSON file with any of the settings below, with underscores, e.g. {\"audio_stream\": \"a:1\", \"buffer\": 0.3}. "
+                                         "Command line flags win over it.")
+    parser.add_argument("--output-dir", help="Where project folders are made (default: the current directory)")
+    parser.add_argument("--prefix", help="Project and media file name, {name} being the video's file name (default: {name})")
+    parser.add_argument("--buffer", type=float, help="Seconds of audio kept around each line (default: 0.5)")
+    parser.add_argument("--audio-stream", help="ffmpeg stream for the card audio, e.g. 1 or a:0 (default: a:0)")
+    parser.add_argument("--subtitle-stream", help="Index of the subtitle stream to use, instead of an external file")
+    parser.add_argument("--subtitle-language", help="Language of the subtitles to pick, e.g. ja")
+    parser.add_argument("--translation-audio-stream", help="Audio stream index to clip for bitmap subtitle lines")
+    parser.add_argument("--clip-codec", choices=sorted(clip_codecs), help="Codec of the audio clips (default: mp3)")
+    parser.add_argument("--clip-bitrate", help="Bitrate of the audio clips, e.g. 64k (default: 128k)")
+    parser.add_argument("--keep-full-audio", action="store_true", default=None, help="Also write the whole audio track to audio.mp3 and cut clips from it")
+    parser.add_argument("--jobs", type=int, help="How many episodes to process at the same time (default: 2)")
+    parser.add_argument("--copy-media", action="store_true", default=None, help="Copy the media files to ~/anki_media/ when done")
+    args = parser.parse_args()
+
+    settings = dict(batch_defaults)
+    if args.config:
+        with open(args.config, "r") as config_file:
+            config = json.load(config_file)
+        unknown = set(config) - set(settings)
+        if unknown:
+            parser.error(f"Unknown settings in {args.config}: {', '.join(sorted(unknown))}")
+        settings.update(config)
+    for key, value in vars(args).items():
+        if key != "config" and value not in (None, []):
+            settings[key] = value
+    if isinstance(settings["inputs"], str):
+        settings["inputs"] = [settings["inputs"]]
+    if settings["clip_codec"] not in clip_codecs:
+        parser.error(f"clip_codec must be one of {', '.join(sorted(clip_codecs))}")
+    return settings
+
 def main():
     # enable tab completion
+    import readline
     readline.parse_and_bind("tab: complete")
 
     output_folder_path, media_prefix = make_project_folder()
@@ -497,4 +1057,7 @@ def main():
 
 
 if __name__ == "__main__":
+    # Any arguments switch to the headless batch mode, otherwise everything is asked for
+    if len(sys.argv) > 1:
+        sys.exit(run_batch(parse_args()))
     main()
@@ -0,0 +1,126 @@
+import os
+import re
+from array import array
+
+# Reads SRT, WebVTT and ASS/SSA subtitles in one pass, without ffmpeg.
+# Timings are kept as whole milliseconds in two int arrays, and inline markup (<i>, {\an8}, ...) is stripped
+# while parsing, so the text comes out ready to put on a card.
+
+# h:mm:ss,mmm in SRT, [h:]mm:ss.mmm in WebVTT and h:mm:ss.cc in ASS
+timestamp_pattern = re.compile(r"(?:(\d+):)?(\d{1,2}):(\d{1,2})[,.](\d{1,3})")
+markup_pattern = re.compile(r"<[^>]*>|{[^}]*}")
+blank_line_pattern = re.compile(r"\n[ \t]*\n")
+
+
+class Subtitles:
+    def __init__(self):
+        self.indices = []
+        self.begin_ms = array("i")
+        self.end_ms = array("i")
+        self.texts = []
+
+    def add(self, index, begin_ms, end_ms, text):
+        self.indices.append(index)
+        self.begin_ms.append(begin_ms)
+        self.end_ms.append(end_ms)
+        self.texts.append(text)
+
+    def with_buffer(self, buffer_ms):
+        # A copy with every line widened by buffer_ms on both sides, never starting before 0
+        buffered = Subtitles()
+        buffered.indices = list(self.indices)
+        buffered.begin_ms = array("i", (max(0, begin - buffer_ms) for begin in self.begin_ms))
+        buffered.end_ms = array("i", (end + buffer_ms for end in self.end_ms))
+        buffered.texts = list(self.texts)
+        return buffered
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __iter__(self):
+        # (index, begin_ms, end_ms, text) for every line
+        return zip(self.indices, self.begin_ms, self.end_ms, self.texts)
+
+
+def timestamp_to_ms(match):
+    hours, minutes, seconds, fraction = match.groups()
+    # The fraction is read as digits after the point, so ASS centiseconds "5" and "50" mean 50 and 500 ms
+    return ((int(hours or 0) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + int(fraction.ljust(3, "0"))
+
+def format_srt_time(ms):
+    seconds, ms = divmod(ms, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{ms:03d}"
+
+def clean_text(lines):
+    # Joins a cue's lines into one, dropping markup, quotes and anything that would break a TSV row
+    text = " ".join(markup_pattern.sub("", line).strip() for line in lines)
+    return " ".join(text.replace("\"", "").split())
+
+def parse_cues(text, subtitles, keep_indices):
+    # SRT and WebVTT: blocks separated by blank lines, each with a "begin --> end" line followed by the text.
+    # Blocks without one (the WEBVTT header, NOTE, STYLE, ...) are skipped.
+    for block in blank_line_pattern.split(text):
+        lines = block.strip("\n").split("\n")
+        for position, line in enumerate(lines):
+            if "-->" in line:
+                break
+        else:
+            continue
+        timestamps = list(timestamp_pattern.finditer(line))
+        dialogue = clean_text(lines[position + 1:])
+        if len(timestamps) < 2 or not dialogue:
+            print(f"Skipping subtitle entry {lines}")
+            continue
+        # SRT numbers name the media files, so they are kept; WebVTT cue ids can be anything, so lines are counted instead
+        index = lines[position - 1].strip() if keep_indices and position > 0 else ""
+        if not index.isdigit():
+            index = str(len(subtitles) + 1)
+        subtitles.add(index, timestamp_to_ms(timestamps[0]), timestamp_to_ms(timestamps[1]), dialogue)
+
+def parse_ass(text, subtitles):
+    # ASS/SSA: Dialogue lines in the [Events] section, laid out by its Format line
+    fields = ["layer", "start", "end", "style", "name", "marginl", "marginr", "marginv", "effect", "text"]
+    events = []
+    in_events = False
+    for line in text.split("\n"):
+        line = line.strip()
+        if line.startswith("["):
+            in_events = line.lower() == "[events]"
+        elif not in_events:
+            continue
+        elif line.lower().startswith("format:"):
+            fields = [field.strip().lower() for field in line[7:].split(",")]
+        elif line.lower().startswith("dialogue:"):
+            values = line[9:].split(",", len(fields) - 1)
+            if len(values) != len(fields):
+                continue
+            event = dict(zip(fields, values))
+            begin = timestamp_pattern.search(event.get("start", ""))
+            end = timestamp_pattern.search(event.get("end", ""))
+            dialogue = clean_text(re.split(r"\\[Nn]", event.get("text", "").replace("\\h", " ")))
+            if begin and end and dialogue:
+                events.append((timestamp_to_ms(begin), timestamp_to_ms(end), dialogue))
+
+    # Events are not necessarily stored in order of time
+    events.sort(key=lambda event: event[0])
+    for begin_ms, end_ms, dialogue in events:
+        subtitles.add(str(len(subtitles) + 1), begin_ms, end_ms, dialogue)
+
+def parse_subtitles(path):
+    with open(path, "r", encoding="utf-8-sig", errors="replace") as subs_file:
+        text = subs_file.read().replace("\r\n", "\n").replace("\r", "\n")
+
+    subtitles = Subtitles()
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".ass", ".ssa") or text.lstrip().startswith("[Script Info]"):
+        parse_ass(text, subtitles)
+    else:
+        parse_cues(text, subtitles, keep_indices=not text.lstrip().startswith("WEBVTT"))
+    return subtitles
+
+def write_srt(subtitles, path):
+    with open(path, "w", encoding="utf-8") as subs_file:
+        subs_file.write("".join(f"{index}\n{format_srt_time(begin_ms)} --> {format_srt_time(end_ms)}\n{text}\n\n"
+                                for index, begin_ms, end_ms, text in subtitles))
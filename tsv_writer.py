@@ -0,0 +1,97 @@
+import os, time
+from typing import List, Optional
+
+
+# A buffered, crash-safe writer for Anki import files, shared by Tatoeba-To-Anki and ankimmerse.
+#
+# Rows are kept in memory and appended in batches, either every flush_rows rows or every flush_seconds seconds,
+# whichever comes first. A kill can at worst lose the unflushed rows or leave a torn final line,
+# and the torn line is cut off the next time the file is opened, so the file always ends on a complete row.
+
+# When should a flushed batch be forced to disk with fsync?
+# "flush" = after every batch, "close" = only when the writer is closed, "never" = leave it to the OS.
+FSYNC_POLICIES = ("flush", "close", "never")
+
+
+class TsvWriter:
+    """
+    Appends lines to a TSV file in batches. Use it as a context manager so the last batch is always written.
+    """
+
+    def __init__(self, path: str, flush_rows: int = 100, flush_seconds: float = 5.0, fsync: str = "flush") -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}, not {fsync!r}")
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.fsync = fsync
+        self.buffer: List[str] = []
+        self.last_flush = time.monotonic()
+        repair_truncated_line(path)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, line: str) -> None:
+        """
+        Queues a line, which must end with a newline, and flushes if the batch is full or old enough.
+        """
+        self.buffer.append(line)
+        if len(self.buffer) >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes all queued lines in one call.
+        """
+        if self.buffer:
+            self.file.write("".join(self.buffer))
+            self.buffer = []
+            self.file.flush()
+            if self.fsync == "flush":
+                os.fsync(self.file.fileno())
+        self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        self.flush()
+        if self.fsync != "never":
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+    def __enter__(self) -> "TsvWriter":
+        return self
+
+    def __exit__(self, *exc_info: Optional[object]) -> None:
+        self.close()
+
+
+def repair_truncated_line(path: str) -> bool:
+    """
+    Cuts off a final line that is missing its newline, as left behind by a write that was interrupted.
+
+    :param path: The path to the TSV file. Nothing happens if it does not exist.
+    :return: True if the file was repaired.
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path, "rb+") as tsv_file:
+        size = tsv_file.seek(0, os.SEEK_END)
+        if size == 0:
+            return False
+        tsv_file.seek(size - 1)
+        if tsv_file.read(1) == b"\n":
+            return False
+
+        # Walk back in blocks to find the end of the last complete line
+        position = size
+        while position > 0:
+            block_start = max(0, position - 65536)
+            tsv_file.seek(block_start)
+            block = tsv_file.read(position - block_start)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                position = block_start + newline + 1
+                break
+            position = block_start
+        tsv_file.truncate(position)
+    print(f"Removed a truncated final line from {path}.")
+    return True